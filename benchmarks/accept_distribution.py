@@ -0,0 +1,91 @@
+"""
+对比多进程模式下的连接分配：
+  - shared:     所有工作进程共享主进程创建的套接字（默认）
+  - reuse_port: 每个工作进程绑定各自的 SO_REUSEPORT 套接字
+
+每个请求使用新连接（`Connection: close`），处理器返回工作进程的 pid，
+统计每个进程 accept 的连接数。
+
+用法: python benchmarks/accept_distribution.py [--workers 4] [--requests 20000]
+"""
+import asyncio
+import os
+import sys
+from argparse import ArgumentParser
+from collections import Counter
+from multiprocessing import get_context
+from statistics import pstdev
+from time import perf_counter, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sanic import Sanic
+from sanic.response import text
+
+
+def run_server(port, workers, reuse_port):
+    app = Sanic('accept_distribution')
+    app.config.WORKER_REUSE_PORT = reuse_port
+
+    @app.route('/')
+    async def pid(request):
+        # 模拟少量 CPU 工作，使繁忙进程与空闲进程的差别可见
+        sum(range(2000))
+        return text(str(os.getpid()))
+
+    app.run(port=port, workers=workers)
+
+
+async def fetch(port, counter, remaining):
+    request = b'GET / HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n'
+    while remaining[0] > 0:
+        remaining[0] -= 1
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(request)
+        data = await reader.read()
+        writer.close()
+        counter[data.rsplit(b'\r\n\r\n', 1)[1]] += 1
+
+
+async def load(port, requests, concurrency):
+    counter = Counter()
+    remaining = [requests]
+    await asyncio.gather(*(fetch(port, counter, remaining)
+                           for _ in range(concurrency)))
+    return counter
+
+
+def bench(mode, port, workers, requests, concurrency):
+    # 使用 spawn 启动服务器，避免继承压测进程的事件循环状态
+    server = get_context('spawn').Process(
+        target=run_server, args=(port, workers, mode == 'reuse_port'))
+    server.start()
+    sleep(1.5)
+    try:
+        start = perf_counter()
+        counter = asyncio.run(load(port, requests, concurrency))
+        elapsed = perf_counter() - start
+    finally:
+        server.terminate()
+        server.join()
+
+    counts = sorted(counter.values(), reverse=True)
+    counts += [0] * (workers - len(counts))
+    mean = requests / workers
+    print('{:<11} {:>8.0f} req/s   per worker: {}'.format(
+        mode, requests / elapsed, counts))
+    print('{:<11} max/mean {:.2f}   min/mean {:.2f}   stdev {:.1f}'.format(
+        '', counts[0] / mean, counts[-1] / mean, pstdev(counts)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    args = parser.parse_args()
+
+    for mode in ('shared', 'reuse_port'):
+        bench(mode, args.port, args.workers, args.requests, args.concurrency)
+        sleep(0.5)
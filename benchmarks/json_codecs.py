@@ -0,0 +1,93 @@
+"""
+对比已注册的 JSON 编解码器（ujson、json，安装后包括 orjson）：
+  - 小、中、大三种典型负载的 loads / dumps 耗时
+  - 大负载在事件循环中直接解码与在线程池中解码时，事件循环的最大停顿
+
+事件循环停顿由每 1ms 唤醒一次的探测协程测量。
+
+用法: python benchmarks/json_codecs.py [--repeat 5]
+"""
+import asyncio
+import os
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sanic import codec
+
+
+def make_payloads():
+    item = {'id': 1, 'name': 'widget', 'tags': ['a', 'b', 'c'],
+            'price': 12.5, 'in_stock': True, 'owner': None}
+    return {
+        'small (api)': {'user': 'alice', 'token': 'x' * 32, 'items': [item] * 5},
+        'medium (list)': {'items': [dict(item, id=i) for i in range(1000)]},
+        'large (export)': {'items': [dict(item, id=i, name='widget-%d' % i)
+                                     for i in range(150000)]},
+    }
+
+
+def best_of(repeat, fn, *args):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        fn(*args)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_codecs(payloads, repeat):
+    print('{:<16} {:<8} {:>10} {:>12} {:>12}'.format(
+        'payload', 'codec', 'size', 'loads', 'dumps'))
+    for name, obj in payloads.items():
+        raw = codec.CODECS['ujson'].dumps(obj).encode()
+        for c in codec.CODECS.values():
+            loads = best_of(repeat, c.loads, raw)
+            dumps = best_of(repeat, c.dumps, obj)
+            print('{:<16} {:<8} {:>10} {:>10.3f}ms {:>10.3f}ms'.format(
+                name, c.name, len(raw), loads * 1e3, dumps * 1e3))
+
+
+async def probe(stop, lags):
+    while not stop.is_set():
+        start = perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(perf_counter() - start - 0.001)
+
+
+async def measure_stall(raw, threshold):
+    codec.use_codec('ujson', threshold)
+    stop = asyncio.Event()
+    lags = []
+    task = asyncio.ensure_future(probe(stop, lags))
+    await asyncio.sleep(0.05)
+    start = perf_counter()
+    await codec.loads_async(raw)
+    elapsed = perf_counter() - start
+    await asyncio.sleep(0.02)
+    stop.set()
+    await task
+    return elapsed, max(lags)
+
+
+def bench_offload(payloads):
+    raw = codec.CODECS['ujson'].dumps(payloads['large (export)']).encode()
+    print()
+    print('event loop stall while decoding {} bytes with ujson'.format(len(raw)))
+    for mode, threshold in (('inline', 0), ('thread', 1)):
+        elapsed, stall = asyncio.run(measure_stall(raw, threshold))
+        print('{:<8} decode {:>8.1f}ms   max loop stall {:>8.1f}ms'.format(
+            mode, elapsed * 1e3, stall * 1e3))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    payloads = make_payloads()
+    bench_codecs(payloads, args.repeat)
+    bench_offload(payloads)
@@ -0,0 +1,69 @@
+"""
+对比查询字符串和 Cookie 的解析：
+  - parse_qs / SimpleCookie:  原有实现
+  - fast (cold):             新解析器，每次都未命中缓存
+  - fast (cached):           新解析器，命中每个进程的缓存
+
+含引号的 Cookie 交给 SimpleCookie 解析，quoted 一项未命中缓存时与原有实现相当。
+
+用法: python benchmarks/request_parsers.py [--number 20000]
+"""
+import os
+import sys
+from argparse import ArgumentParser
+from http.cookies import SimpleCookie
+from timeit import timeit
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sanic.request import (
+    RequestParameters, parse_query_string, parse_cookie)
+
+QUERY_STRINGS = {
+    'short': 'page=2',
+    'typical': 'q=red+shoes&category=footwear&sort=price_asc&page=3&size=42',
+    'encoded': 'q=%E4%B8%AD%E6%96%87&tags=a&tags=b&tags=c&redirect=%2Fa%2Fb%3Fc%3Dd',
+}
+
+COOKIES = {
+    'single': 'session=3f2a9c1e7b8d4f6a',
+    'typical': 'session=3f2a9c1e7b8d4f6a; csrftoken=Xk9LmN2pQr; theme=dark; '
+               'lang=zh-CN; _ga=GA1.2.1234567890.1234567890',
+    'quoted': 'session="3f2a 9c1e"; prefs="a=1; b=2"; user=alice',
+}
+
+
+def old_args(query_string):
+    return RequestParameters(parse_qs(query_string))
+
+
+def old_cookies(cookie):
+    cookies = SimpleCookie()
+    cookies.load(cookie)
+    return {name: morsel.value for name, morsel in cookies.items()}
+
+
+def bench(title, cases, old, fast, number):
+    print(title)
+    print('{:<10} {:>14} {:>14} {:>14}'.format(
+        'case', 'original', 'fast (cold)', 'fast (cached)'))
+    for name, raw in cases.items():
+        original = timeit(lambda: old(raw), number=number)
+        cold = timeit(lambda: fast.__wrapped__(raw), number=number)
+        fast(raw)
+        cached = timeit(lambda: fast(raw), number=number)
+        print('{:<10} {:>12.2f}us {:>12.2f}us {:>12.2f}us'.format(
+            name, original / number * 1e6, cold / number * 1e6,
+            cached / number * 1e6))
+    print()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    bench('query string', QUERY_STRINGS, old_args, parse_query_string,
+          args.number)
+    bench('cookie', COOKIES, old_cookies, parse_cookie, args.number)
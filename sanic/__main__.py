@@ -10,6 +10,9 @@ if __name__ == '__main__':
     # 添加参数
     parser.add_argument('--host', dest='host', type=str, default='127.0.0.1')
     parser.add_argument('--port', dest='port', type=int, default=8000)
+    parser.add_argument('--uds', dest='uds', type=str, default=None,
+                        help='监听的 Unix 域套接字路径')
+    parser.add_argument('--backlog', dest='backlog', type=int, default=100)
     parser.add_argument('--workers', dest='workers', type=int, default=1, )
     parser.add_argument('--debug', dest='debug', action='store_true')
     parser.add_argument('module')
@@ -32,8 +35,8 @@ if __name__ == '__main__':
                              "Perhaps you meant {}.app"
                              .format(type(app).__name__, args.module))
         # 运行项目
-        app.run(host=args.host, port=args.port,
-                workers=args.workers, debug=args.debug)
+        app.run(host=args.host, port=args.port, uds=args.uds,
+                backlog=args.backlog, workers=args.workers, debug=args.debug)
     except ImportError:     # 导入异常
         log.error("No module named {} found. \n"
                   " Example File: project/sanic_server.py -> app\n"
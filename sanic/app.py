@@ -1,20 +1,45 @@
-from os import set_inheritable
-from socket import socket, SOL_SOCKET, SO_REUSEADDR
+from os import set_inheritable, unlink
 from asyncio import get_event_loop
-from inspect import isawaitable, stack, getmodulename
-from multiprocessing import Process, Event
-from signal import signal, SIGTERM, SIGINT
+from inspect import isawaitable, iscoroutinefunction, stack, getmodulename
+from multiprocessing import Event
+from time import monotonic
 from traceback import format_exc
-from collections import deque
+from collections import deque, defaultdict, namedtuple, OrderedDict
+from functools import partial
 import logging
 
 
+from sanic import codec
+from sanic.bulkhead import Bulkhead
+from sanic.cache import ResponseCache
 from sanic.config import Config
-from sanic.exceptions import Handler, ServerError
+from sanic.exceptions import Handler, NotFound, InvalidUsage
 from sanic.log import log
-from sanic.response import HTTPResponse
-from sanic.server import serve, HttpProtocol
+from sanic.response import (
+    HTTPResponse, StreamingHTTPResponse, FileHTTPResponse,
+    make_etag, is_not_modified, not_modified)
+from sanic.server import serve, bind_socket, HttpProtocol
 from sanic.router import Router
+from sanic.static import register as static_register, StaticFileCache
+from sanic.supervisor import Supervisor
+
+# 编译后的中间件调用链，每项为 (中间件, 是否为协程函数)，没有中间件时为空元组。
+# 被装饰器包装的协程函数、partial 和可调用对象也可能返回 awaitable，执行时再检查
+MiddlewareChain = namedtuple('MiddlewareChain', ['request', 'response'])
+
+
+def compile_middleware_chain(request_middleware, response_middleware):
+    """
+    将中间件列表编译为调用链，在启动时判断每个中间件是否需要 await
+    :return: MiddlewareChain，没有任何中间件时返回 None
+    """
+    if not request_middleware and not response_middleware:
+        return None
+    return MiddlewareChain(
+        request=tuple((middleware, iscoroutinefunction(middleware))
+                      for middleware in request_middleware),
+        response=tuple((middleware, iscoroutinefunction(middleware))
+                       for middleware in response_middleware))
 
 
 class Sanic:
@@ -38,8 +63,20 @@ class Sanic:
         self.processes = None
         self.request_middleware = deque()                   # 请求中间件
         self.response_middleware = deque()                  # 响应中间件
+        # 蓝图中间件，只作用于该蓝图的路由
+        self.blueprint_request_middleware = defaultdict(deque)
+        self.blueprint_response_middleware = defaultdict(deque)
+        self.middleware_chain = None                        # 应用级中间件调用链
+        self.route_middleware = {}                          # 路由路径 -> 中间件调用链
+        self.route_blueprints = {}                          # 路由路径 -> 所属蓝图名称
+        self._middleware_compiled = False                   # 中间件是否已编译
         self.blueprints = {}  # 蓝图
         self._blueprint_order = []
+        self.is_request_stream = False                      # 是否存在流式路由
+        self.route_body_limits = False                      # 是否存在单独设置消息体上限的路由
+        self.bulkheads = {}                                 # 路由隔舱
+        self.etag_cache = OrderedDict()     # (处理器, url, 查询字符串) -> (ETag, 过期时间)
+        self.response_cache = ResponseCache()   # `@cache` 路由的响应缓存
 
 
     # -------------------------------------------------------------------- #
@@ -47,33 +84,68 @@ class Sanic:
     # -------------------------------------------------------------------- #
 
     # 路由装饰器
-    def route(self, uri, methods=None):
+    def route(self, uri, methods=None, stream=False, max_body_size=None,
+              concurrency=None, queue_size=0, priority=0, bulkhead=None,
+              etag_ttl=None, blueprint=None):
         """
         使用装饰器将处理函数注册为路由
         :param uri: URL 路径
         :param methods: 允许的请求方法
+        :param stream: 是否以流的方式读取请求消息体 `request.stream`
+        :param max_body_size: 该路由的消息体大小上限，`None` 使用
+                              `REQUEST_MAX_SIZE`
+        :param concurrency: 该路由同时执行的处理器数上限，`None` 为不限制
+        :param queue_size: 超出并发数后排队等待的请求数上限，队列满时返回 503
+        :param priority: 排队时的优先级，数值越大越先执行
+        :param bulkhead: 与其它路由共享的 Bulkhead 对象，代替 concurrency
+                         和 queue_size
+        :param etag_ttl: 以秒为单位，缓存该路由按 URL 和查询参数生成的 ETag，
+                         期间 `If-None-Match` 命中时不执行处理器直接返回 304，
+                         `None` 为不缓存
+        :param blueprint: 所属蓝图名称，编译中间件时为该路由加入蓝图中间件
         :return: 被装饰后的函数
         """
         if not uri.startswith('/'):
             uri = '/' + uri
 
+        if stream:
+            self.is_request_stream = True
+
         def response(handler):
+            if stream:
+                handler.is_stream = stream
+            if max_body_size is not None:
+                handler.max_body_size = max_body_size
+                self.route_body_limits = True
+            _bulkhead = bulkhead
+            if _bulkhead is None and concurrency is not None:
+                _bulkhead = Bulkhead(uri, concurrency, queue_size)
+            if _bulkhead is not None:
+                handler.bulkhead = _bulkhead
+                handler.priority = priority
+                self.bulkheads[_bulkhead.name] = _bulkhead
+            if etag_ttl is not None:
+                handler.etag_ttl = etag_ttl
+            self._middleware_compiled = False
             # 调用 Router.add 方法添加路由
             self.router.add(uri=uri, methods=methods, handler=handler)
+            if blueprint is not None:
+                self.route_blueprints[uri] = blueprint
             return handler
 
         return response
 
     # 添加路由
-    def add_route(self, handler, uri, methods=None):
+    def add_route(self, handler, uri, methods=None, **options):
         """
         注册路由的非装饰器方法
         :param handler: 处理器函数
         :param uri: URL 路径
         :param methods: 允许的请求方法
+        :param options: 路由选项，见 `route`
         :return:
         """
-        self.route(uri=uri, methods=methods)(handler)
+        self.route(uri=uri, methods=methods, **options)(handler)
         return handler
 
 
@@ -87,11 +159,7 @@ class Sanic:
         attach_to = 'request'
 
         def register_middleware(middleware):
-            if attach_to == 'request':
-                self.request_middleware.append(middleware)
-            if attach_to == 'response':
-                self.response_middleware.appendleft(middleware)
-            return middleware
+            return self.register_middleware(middleware, attach_to)
 
         # 检查被调用方式, `@middleware` or `@middleware('AT')`
         if len(args) == 1 and len(kwargs) == 0 and callable(args[0]):
@@ -100,6 +168,47 @@ class Sanic:
             attach_to = args[0]
             return register_middleware
 
+    def register_middleware(self, middleware, attach_to='request',
+                            blueprint=None):
+        """
+        注册中间件，响应中间件按注册的逆序执行
+        :param middleware: 中间件函数
+        :param attach_to: 'request' 或 'response'
+        :param blueprint: 蓝图名称，指定后只作用于该蓝图的路由
+        :return: 中间件函数
+        """
+        if blueprint is None:
+            request_middleware = self.request_middleware
+            response_middleware = self.response_middleware
+        else:
+            request_middleware = self.blueprint_request_middleware[blueprint]
+            response_middleware = \
+                self.blueprint_response_middleware[blueprint]
+
+        if attach_to == 'request':
+            request_middleware.append(middleware)
+        if attach_to == 'response':
+            response_middleware.appendleft(middleware)
+        self._middleware_compiled = False
+        return middleware
+
+    def compile_middleware(self):
+        """
+        为每个路由编译中间件调用链：先执行应用级请求中间件，再执行蓝图的；
+        响应中间件顺序相反。蓝图路由的调用链按路径保存在 route_middleware 中，
+        其它路由使用应用级调用链，没有中间件时调用链为 None
+        """
+        self.middleware_chain = compile_middleware_chain(
+            self.request_middleware, self.response_middleware)
+        self.route_middleware = {}
+        for uri, blueprint in self.route_blueprints.items():
+            self.route_middleware[uri] = compile_middleware_chain(
+                list(self.request_middleware) +
+                list(self.blueprint_request_middleware.get(blueprint, ())),
+                list(self.blueprint_response_middleware.get(blueprint, ())) +
+                list(self.response_middleware))
+        self._middleware_compiled = True
+
     # 异常装饰器
     def exception(self, *exceptions):
         """
@@ -113,6 +222,23 @@ class Sanic:
 
         return response
 
+    # 静态文件
+    def static(self, uri, file_or_directory, pattern='.+',
+               cache_size=1024, max_memory_file_size=64 * 1024,
+               max_open_files=128):
+        """
+        注册静态文件或目录路由
+        :param uri: URL 路径
+        :param file_or_directory: 静态文件或目录路径
+        :param pattern: 匹配目录下文件路径的正则表达式
+        :param cache_size: 缓存的文件元数据条目上限
+        :param max_memory_file_size: 不超过该大小的文件内容缓存在内存中
+        :param max_open_files: 保持打开的大文件数上限
+        """
+        cache = StaticFileCache(cache_size, max_memory_file_size,
+                                max_open_files)
+        static_register(self, uri, file_or_directory, pattern, cache)
+
     # 蓝图
     def blueprint(self, blueprint, **options):
         """
@@ -140,26 +266,39 @@ class Sanic:
     # def converted_response_type(self, response):
     #     pass
 
-    async def handle_request(self, request, response_callback):
+    async def handle_request(self, request, write_callback, stream_callback):
         """
         从 HTTP 服务器获取请求，并发送可异步的响应对象，
         因为 HTTP 服务器只期望发送响应对象，所以需要在这里进行异常处理
         :param request: HTTP 请求对象
-        :param response_callback: 可异步的 response 回调函数
+        :param write_callback: 写入完整 response 的回调函数
+        :param stream_callback: 写入流式 response 的协程函数
         """
         try:
 
             response = False
 
+            if not self._middleware_compiled:
+                self.compile_middleware()
+
+            # 在路由中获得处理函数和编译好的中间件调用链
+            try:
+                route, kwargs = self.router.get_route(request)
+                handler, args = route.handler, []
+                chain = self.route_middleware.get(
+                    route.uri, self.middleware_chain)
+            except (NotFound, InvalidUsage) as e:
+                # 未匹配的路由只执行应用级中间件，随后抛出异常
+                handler, chain, error = None, self.middleware_chain, e
+
             # -------------------------------------------- #
             # 请求中间件
             # -------------------------------------------- #
 
-            # 执行请求中间件
-            if self.request_middleware:
-                for middleware in self.request_middleware:
+            if chain is not None:
+                for middleware, is_async in chain.request:
                     response = middleware(request)
-                    if isawaitable(response):
+                    if is_async or isawaitable(response):
                         response = await response
                     if response:
                         break
@@ -170,32 +309,48 @@ class Sanic:
                 # 执行处理器
                 # -------------------------------------------- #
 
-                # 在路由中获得处理函数
-                handler, args, kwargs = self.router.get(request)
                 if handler is None:
-                    raise ServerError(
-                        ("'None' was returned while requesting a "
-                         "handler from the router"))
+                    raise error
 
-                # Run response handler
-                response = handler(request, *args, **kwargs)
-                if isawaitable(response):
-                    response = await response
+                # 缓存的 ETag 仍然有效时不执行处理器
+                if getattr(handler, 'etag_ttl', None) is not None:
+                    response = self.cached_not_modified(request, handler)
 
+            if not response:
+                cache_ttl = getattr(handler, 'cache_ttl', None)
+                if cache_ttl is not None and \
+                        (request.method == 'GET' or request.method == 'HEAD'):
+                    # 命中缓存时不执行处理器，也不占用隔舱
+                    response = await self.response_cache.fetch(
+                        self.response_cache.make_key(
+                            request, handler.cache_vary),
+                        cache_ttl,
+                        partial(self.run_handler, handler, request,
+                                args, kwargs))
+                else:
+                    response = await self.run_handler(
+                        handler, request, args, kwargs)
 
             # -------------------------------------------- #
             # 响应中间件
             # --------------------------------------------
 
-            if self.response_middleware:
-                for middleware in self.response_middleware:
+            if chain is not None:
+                for middleware, is_async in chain.response:
                     _response = middleware(request, response)
-                    if isawaitable(_response):
+                    if is_async or isawaitable(_response):
                         _response = await _response
                     if _response:
                         response = _response
                         break
 
+            # 条件请求：在写入消息体或打开文件之前替换为 304
+            if (request.method == 'GET' or request.method == 'HEAD') and \
+                    type(response) in (HTTPResponse, FileHTTPResponse) and \
+                    response.status == 200:
+                response = self.conditional_response(
+                    request, handler, response)
+
         except Exception as e:
             # -------------------------------------------- #
             # 生成响应失败
@@ -215,7 +370,97 @@ class Sanic:
                         "An error occured while handling an error")
 
         # 回调函数处理 response
-        response_callback(response)
+        if isinstance(response, (StreamingHTTPResponse, FileHTTPResponse)):
+            await stream_callback(response)
+        else:
+            write_callback(response)
+
+    def register_json_codec(self, name, loads, dumps):
+        """
+        注册 JSON 编解码器，通过 `config.JSON_CODEC` 选择
+        :param name: 名称
+        :param loads: 接受 str 或 bytes，返回对象
+        :param dumps: 接受对象，返回 str 或 bytes
+        """
+        codec.register_codec(name, loads, dumps)
+
+    async def run_handler(self, handler, request, args, kwargs):
+        """
+        执行处理器，设置了隔舱的路由在隔舱中执行
+        """
+        bulkhead = getattr(handler, 'bulkhead', None)
+        if bulkhead is None:
+            response = handler(request, *args, **kwargs)
+            if isawaitable(response):
+                response = await response
+            return response
+
+        await bulkhead.acquire(handler.priority)
+        try:
+            response = handler(request, *args, **kwargs)
+            if isawaitable(response):
+                response = await response
+            return response
+        finally:
+            bulkhead.release()
+
+    def conditional_response(self, request, handler, response):
+        """
+        为响应补充 ETag，请求的验证器匹配时返回 304
+        :param request: HTTP 请求对象
+        :param handler: 处理器，没有匹配的路由时为 None
+        :param response: 状态码为 200 的响应
+        :return: 原响应或 304 响应
+        """
+        headers = response.headers
+        etag = headers.get('ETag')
+        if etag is None and type(response) is HTTPResponse and \
+                self.config.RESPONSE_AUTO_ETAG:
+            # 调用方可能传入共享的头部字典，复制后再写入
+            headers = response.headers = dict(headers)
+            etag = headers['ETag'] = make_etag(response.body)
+
+        etag_ttl = getattr(handler, 'etag_ttl', None)
+        if etag is not None and etag_ttl is not None:
+            key = (handler, request.url, request.query_string)
+            cache = self.etag_cache
+            cache[key] = (etag, monotonic() + etag_ttl)
+            cache.move_to_end(key)
+            if len(cache) > self.config.ETAG_CACHE_SIZE:
+                cache.popitem(last=False)
+
+        if is_not_modified(request.headers, etag, headers.get('Last-Modified')):
+            return not_modified(headers)
+        return response
+
+    def cached_not_modified(self, request, handler):
+        """
+        `If-None-Match` 与缓存的 ETag 匹配时返回 304，否则返回 None
+        """
+        if request.method != 'GET' and request.method != 'HEAD':
+            return None
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is None:
+            return None
+        key = (handler, request.url, request.query_string)
+        cached = self.etag_cache.get(key)
+        if cached is None:
+            return None
+        etag, expires = cached
+        if expires < monotonic():
+            del self.etag_cache[key]
+            return None
+        if not is_not_modified(request.headers, etag):
+            return None
+        return not_modified({'ETag': etag})
+
+    def bulkhead_stats(self):
+        """
+        获取各路由隔舱的统计信息
+        :return: {隔舱名称: BulkheadStats}
+        """
+        return {name: bulkhead.stats()
+                for name, bulkhead in self.bulkheads.items()}
 
     # -------------------------------------------------------------------- #
     # 执行
@@ -223,7 +468,7 @@ class Sanic:
 
     def run(self, host="127.0.0.1", port=8000, debug=False, sock=None,
             workers=1, loop=None, protocol=HttpProtocol, backlog=100,
-            stop_event=None):
+            stop_event=None, uds=None):
         """
         运行 HTTP 服务器并一直监听，直到收到键盘终端操作或终止信号。
         在终止时，在关闭时释放所有连接。
@@ -234,11 +479,20 @@ class Sanic:
         :param workers: 进程数
         :param loop: 异步事件循环
         :param protocol: 异步协议子类
+        :param backlog: 等待 accept 的连接数上限
+        :param stop_event: 多进程模式下的终止事件
+        :param uds: 监听的 Unix 域套接字路径，指定后忽略 host 和 port
         """
         self.error_handler.debug = True
         self.debug = debug
         self.loop = loop
 
+        # 启动前编译中间件调用链，预加载模式下由工作进程共享
+        self.compile_middleware()
+        # 启动前检查编解码器是否已注册
+        codec.use_codec(self.config.JSON_CODEC,
+                        self.config.JSON_OFFLOAD_THRESHOLD)
+
         # 配置 server 参数
         server_settings = {
             'protocol': protocol,
@@ -248,17 +502,60 @@ class Sanic:
             'debug': debug,
             'request_handler': self.handle_request,
             'error_handler': self.error_handler,
-            'request_timeout': self.config.REQUEST_TIMEOUT,
+            'keep_alive_timeout': self.config.KEEP_ALIVE_TIMEOUT,
+            'request_header_timeout': self.config.REQUEST_HEADER_TIMEOUT,
+            'request_body_timeout': self.config.REQUEST_BODY_TIMEOUT,
+            'request_max_header_size': self.config.REQUEST_MAX_HEADER_SIZE,
+            'request_max_headers': self.config.REQUEST_MAX_HEADERS,
+            'request_body_min_rate': self.config.REQUEST_BODY_MIN_RATE,
+            'request_body_rate_period': self.config.REQUEST_BODY_RATE_PERIOD,
+            'response_timeout': self.config.RESPONSE_TIMEOUT,
             'request_max_size': self.config.REQUEST_MAX_SIZE,
+            'request_buffer_queue_size': self.config.REQUEST_BUFFER_QUEUE_SIZE,
+            'multipart_spill_size': self.config.REQUEST_MULTIPART_SPILL_SIZE,
+            'router': self.router,
+            'is_request_stream': self.is_request_stream,
+            'route_body_limits': self.route_body_limits,
+            'pipeline_size': self.config.REQUEST_PIPELINE_SIZE,
+            'pipeline_concurrency': self.config.REQUEST_PIPELINE_CONCURRENCY,
+            'graceful_shutdown_timeout': self.config.GRACEFUL_SHUTDOWN_TIMEOUT,
+            'max_connections': self.config.MAX_CONNECTIONS,
+            'max_in_flight': self.config.MAX_IN_FLIGHT_REQUESTS,
+            'shed_target': self.config.SHED_QUEUE_TARGET,
+            'shed_interval': self.config.SHED_QUEUE_INTERVAL,
+            'retry_after': self.config.OVERLOAD_RETRY_AFTER,
+            'json_codec': self.config.JSON_CODEC,
+            'json_offload_threshold': self.config.JSON_OFFLOAD_THRESHOLD,
             'loop': loop,
-            'backlog': backlog
+            'backlog': backlog,
+            'uds': uds,
+            'socket_options': {
+                'tcp_nodelay': self.config.TCP_NODELAY,
+                'tcp_defer_accept': self.config.TCP_DEFER_ACCEPT,
+                'keepalive': self.config.SO_KEEPALIVE,
+                'send_buffer': self.config.SOCKET_SEND_BUFFER,
+                'receive_buffer': self.config.SOCKET_RECEIVE_BUFFER,
+            },
         }
 
         if debug:
             log.setLevel(logging.DEBUG)
 
+        # 应用配置中的路由缓存大小
+        self.router.configure_cache(
+            self.config.ROUTER_CACHE_SIZE,
+            self.config.ROUTER_NEGATIVE_CACHE_SIZE,
+            self.config.ROUTER_CACHE_ROUTE_LIMIT)
+        self.response_cache.configure(
+            self.config.RESPONSE_CACHE_MAX_ENTRIES,
+            self.config.RESPONSE_CACHE_MAX_MEMORY,
+            self.config.RESPONSE_AUTO_ETAG)
+
         # 启动服务进程
-        log.info('Goin\' Fast @ http://{}:{}'.format(host, port))
+        if uds is not None:
+            log.info('Goin\' Fast @ unix:{}'.format(uds))
+        else:
+            log.info('Goin\' Fast @ http://{}:{}'.format(host, port))
 
         try:
             if workers == 1:
@@ -281,7 +578,8 @@ class Sanic:
         if self.processes is not None:
             for process in self.processes:
                 process.terminate()
-            self.sock.close()
+            if self.sock is not None:
+                self.sock.close()
         get_event_loop().stop()
 
 
@@ -289,36 +587,45 @@ class Sanic:
         """
         同时启动多个服务器进程。一直监听直到收到键盘终端操作或终止型号。
         在终止时，在关闭时释放所有连接。
+        工作进程退出后自动重启，收到 SIGHUP 时逐个替换所有工作进程。
         :param server_settings: 服务配置参数
         :param workers: 进程数
         :param stop_event: 终止事件
         :return:
         """
-        server_settings['reuse_port'] = True
-
-        # Create a stop event to be triggered by a signal
+        # 终止事件可由其它进程设置，终止信号由 supervisor 处理
         if stop_event is None:
             stop_event = Event()
-        signal(SIGINT, lambda s, f: stop_event.set())
-        signal(SIGTERM, lambda s, f: stop_event.set())
-
-        self.sock = socket()
-        self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        self.sock.bind((server_settings['host'], server_settings['port']))
-        set_inheritable(self.sock.fileno(), True)
-        server_settings['sock'] = self.sock
-        server_settings['host'] = None
-        server_settings['port'] = None
-
-        self.processes = []
-        for _ in range(workers):
-            process = Process(target=serve, kwargs=server_settings)
-            process.daemon = True
-            process.start()
-            self.processes.append(process)
-
-        for process in self.processes:
-            process.join()
+
+        uds = server_settings['uds']
+        if uds is None and self.config.WORKER_REUSE_PORT:
+            # 每个工作进程绑定各自的 SO_REUSEPORT 套接字，由内核均衡分配连接
+            server_settings['reuse_port'] = True
+            self.sock = None
+        else:
+            # 所有工作进程共享主进程创建的套接字
+            self.sock = bind_socket(
+                server_settings['host'], server_settings['port'], uds=uds,
+                backlog=server_settings['backlog'],
+                **server_settings['socket_options'])
+            set_inheritable(self.sock.fileno(), True)
+            server_settings['sock'] = self.sock
+            server_settings['host'] = None
+            server_settings['port'] = None
+
+        # 由 supervisor 启动并看管工作进程，直到收到终止信号
+        supervisor = Supervisor(
+            serve, server_settings, workers,
+            max_requests=self.config.WORKER_MAX_REQUESTS,
+            max_requests_jitter=self.config.WORKER_MAX_REQUESTS_JITTER,
+            max_rss=self.config.WORKER_MAX_RSS,
+            check_interval=self.config.WORKER_CHECK_INTERVAL,
+            graceful_timeout=self.config.GRACEFUL_SHUTDOWN_TIMEOUT,
+            preload=self.config.WORKER_PRELOAD)
+        self.processes = supervisor.processes
+        supervisor.run(stop_event)
 
         # 上面的进程直到它们停止前将会阻塞
         self.stop()
+        if uds is not None:
+            unlink(uds)
@@ -23,14 +23,18 @@ class BlueprintSetup:
     # 以下方法都是调用 Sanic 对象实现
     #
 
-    def add_route(self, handler, uri, methods):
+    def add_route(self, handler, uri, methods, **options):
         """
-        注册路由。
+        注册路由。未指定消息体大小上限时使用蓝图的设置
         """
         if self.url_prefix:
             uri = self.url_prefix + uri
+        if options.get('max_body_size') is None:
+            options = dict(options, max_body_size=self.blueprint.max_body_size)
 
-        self.app.route(uri=uri, methods=methods)(handler)
+        # 记录所属蓝图，编译中间件时只为这些路由加入蓝图中间件
+        self.app.route(uri=uri, methods=methods, blueprint=self.blueprint.name,
+                       **options)(handler)
 
     def add_exception(self, handler, *args, **kwargs):
         """
@@ -40,26 +44,27 @@ class BlueprintSetup:
 
     def add_middleware(self, middleware, *args, **kwargs):
         """
-        注册中间件。
+        注册中间件，只作用于此蓝图的路由。
         """
-        if args or kwargs:
-            self.app.middleware(*args, **kwargs)(middleware)
-        else:
-            self.app.middleware(middleware)
+        attach_to = args[0] if args else kwargs.get('attach_to', 'request')
+        self.app.register_middleware(
+            middleware, attach_to, blueprint=self.blueprint.name)
 
 
 class Blueprint:
     """
     蓝图，实现了与 Sanic 一样的调用方法。
     """
-    def __init__(self, name, url_prefix=None):
+    def __init__(self, name, url_prefix=None, max_body_size=None):
         """
         创建一个新蓝图
         :param name: 蓝图名称
         :param url_prefix:  所有 URLs 的前缀
+        :param max_body_size: 此蓝图所有路由的消息体大小上限
         """
         self.name = name                    # 蓝图名，唯一
         self.url_prefix = url_prefix        # 路由前缀
+        self.max_body_size = max_body_size  # 消息体大小上限
         self.deferred_functions = []        # 推迟执行的函数集合
 
     def record(self, func):
@@ -86,20 +91,21 @@ class Blueprint:
     #   - s 代表 BlueprintSetup 对象
     #
     
-    def route(self, uri, methods=None):
+    def route(self, uri, methods=None, **options):
         """
-        路由装饰器
+        路由装饰器，路由选项与 `Sanic.route` 相同
         """
         def decorator(handler):
-            self.record(lambda s: s.add_route(handler, uri, methods))
+            self.record(lambda s: s.add_route(
+                handler, uri, methods, **options))
             return handler
         return decorator
 
-    def add_route(self, handler, uri, methods=None):
+    def add_route(self, handler, uri, methods=None, **options):
         """
         添加路由非装饰器方法
         """
-        self.record(lambda s: s.add_route(handler, uri, methods))
+        self.record(lambda s: s.add_route(handler, uri, methods, **options))
         return handler
 
     def middleware(self, *args, **kwargs):
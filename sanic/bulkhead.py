@@ -0,0 +1,100 @@
+from asyncio import CancelledError, get_event_loop
+from collections import namedtuple
+from heapq import heappush, heappop
+from itertools import count
+from time import monotonic
+
+from sanic.exceptions import ServiceUnavailable
+
+# 隔舱统计信息
+BulkheadStats = namedtuple('BulkheadStats', [
+    'active', 'queued', 'accepted', 'rejected', 'mean_wait', 'max_wait'])
+
+
+class Bulkhead:
+    """
+    路由隔舱，限制一组路由同时执行的处理器数。
+    超出的请求进入有界队列等待，队列已满时返回 503；
+    队列按优先级排序，优先级高的请求先获得执行机会。
+    多个路由可以共享同一个隔舱。
+    """
+    __slots__ = ('name', 'concurrency', 'queue_size', 'active',
+                 '_waiters', '_queued', '_counter', 'accepted', 'rejected',
+                 '_waited', '_total_wait', 'max_wait')
+
+    def __init__(self, name, concurrency, queue_size=0):
+        """
+        :param name: 隔舱名称，用于统计
+        :param concurrency: 同时执行的处理器数上限
+        :param queue_size: 等待队列长度上限，0 为不排队直接拒绝
+        """
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.active = 0             # 正在执行的处理器数
+        self._waiters = []          # (-priority, 序号, future) 组成的堆
+        self._queued = 0            # 等待中的请求数，不含已取消的 future
+        self._counter = count()     # 保证同一优先级先进先出
+        self.accepted = 0           # 获得执行机会的请求数
+        self.rejected = 0           # 队列已满被拒绝的请求数
+        self._waited = 0            # 排过队的请求数
+        self._total_wait = 0        # 总排队时间
+        self.max_wait = 0           # 最长排队时间
+
+    async def acquire(self, priority=0):
+        """
+        获取执行机会，需要时排队等待
+        :param priority: 优先级，数值越大越先执行
+        """
+        if self.active < self.concurrency and not self._queued:
+            self.active += 1
+            self.accepted += 1
+            return
+
+        if self._queued >= self.queue_size:
+            self.rejected += 1
+            raise ServiceUnavailable('Route {} overloaded'.format(self.name))
+
+        future = get_event_loop().create_future()
+        heappush(self._waiters, (-priority, next(self._counter), future))
+        self._queued += 1
+        queued_at = monotonic()
+        try:
+            await future
+        except CancelledError:
+            if future.cancelled():  # 仍在队列中，出队时跳过
+                self._queued -= 1
+            else:   # 已获得执行机会，交给下一个请求
+                self.release()
+            raise
+
+        # release 已经把执行机会转交过来，active 不变
+        wait = monotonic() - queued_at
+        self.accepted += 1
+        self._waited += 1
+        self._total_wait += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+
+    def release(self):
+        """
+        释放执行机会，交给队列中优先级最高的请求
+        """
+        while self._waiters:
+            future = heappop(self._waiters)[2]
+            if future.cancelled():
+                continue
+            self._queued -= 1
+            future.set_result(None)
+            return
+        self.active -= 1
+
+    def stats(self):
+        """
+        返回统计信息
+        """
+        mean_wait = self._total_wait / self._waited if self._waited else 0
+        return BulkheadStats(
+            active=self.active, queued=self._queued,
+            accepted=self.accepted, rejected=self.rejected,
+            mean_wait=mean_wait, max_wait=self.max_wait)
@@ -0,0 +1,216 @@
+from asyncio import get_event_loop, shield
+from collections import OrderedDict, namedtuple
+from time import monotonic
+
+from sanic.response import HTTPResponse, make_etag
+
+# 响应缓存统计信息
+CacheStats = namedtuple('CacheStats', [
+    'entries', 'memory', 'hits', 'misses', 'coalesced', 'evictions'])
+
+ENTRY_OVERHEAD = 256    # 估算每个条目除消息体和头部以外占用的内存
+
+
+class CacheEntry:
+    """
+    缓存的响应，保存序列化后的消息体
+    """
+    __slots__ = ('status', 'content_type', 'headers', 'body', 'size',
+                 'expires')
+
+    def __init__(self, response, expires, add_etag):
+        headers = dict(response.headers)
+        if add_etag and 'ETag' not in headers:  # 命中时不再重复计算
+            headers['ETag'] = make_etag(response.body)
+        self.status = response.status
+        self.content_type = response.content_type
+        self.headers = headers
+        self.body = response.body
+        self.expires = expires
+        self.size = len(self.body) + ENTRY_OVERHEAD + sum(
+            len(str(name)) + len(str(value))
+            for name, value in headers.items())
+
+    def response(self):
+        """
+        生成新的响应对象，头部复制一份供响应中间件修改
+        """
+        return HTTPResponse(status=self.status, headers=dict(self.headers),
+                            content_type=self.content_type,
+                            body_bytes=self.body)
+
+
+class ResponseCache:
+    """
+    路由响应缓存，LRU 淘汰，同时限制条目数和估算的内存占用。
+    同一个键同时未命中时只执行一次处理器，其它请求等待其结果。
+    键以请求路径开头，可以按前缀使缓存失效。
+    """
+
+    def __init__(self, max_entries=1024, max_memory=64 * 1024 * 1024,
+                 add_etag=True):
+        """
+        :param max_entries: 缓存条目上限
+        :param max_memory: 以字节为单位，缓存占用的内存上限
+        :param add_etag: 是否在缓存时生成 ETag
+        """
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.add_etag = add_etag
+        self.memory = 0                 # 当前估算的内存占用
+        self.hits = 0                   # 命中次数
+        self.misses = 0                 # 未命中而执行处理器的次数
+        self.coalesced = 0              # 等待其它请求结果的次数
+        self.evictions = 0              # 因容量淘汰的条目数
+        self._entries = OrderedDict()   # 键 -> CacheEntry
+        self._pending = {}              # 键 -> 等待处理器结果的 future
+        self._generation = 0            # 每次失效后增加，丢弃失效前开始的结果
+
+    def configure(self, max_entries=None, max_memory=None, add_etag=None):
+        """
+        更改缓存容量
+        """
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_memory is not None:
+            self.max_memory = max_memory
+        if add_etag is not None:
+            self.add_etag = add_etag
+        self._evict()
+
+    @staticmethod
+    def make_key(request, vary=None):
+        """
+        生成缓存键：路径、查询字符串以及 vary 中各请求头的值
+        :param request: HTTP 请求对象
+        :param vary: 请求头名称列表
+        """
+        key = request.url
+        if request.query_string:
+            key += '?' + request.query_string
+        if vary:
+            headers = request.headers
+            key += ''.join('\n%s:%s' % (name, headers.get(name) or '')
+                           for name in vary)
+        return key
+
+    def get(self, key):
+        """
+        返回未过期的缓存条目，不存在时返回 None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires < monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    async def fetch(self, key, ttl, produce):
+        """
+        返回缓存的响应，未命中时执行 produce 生成响应并缓存
+        :param key: 缓存键
+        :param ttl: 以秒为单位，缓存有效时间
+        :param produce: 返回响应的协程函数
+        """
+        entry = self.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry.response()
+
+        future = self._pending.get(key)
+        if future is not None:
+            # 等待正在执行的处理器，shield 避免取消等待时取消共享的 future
+            self.coalesced += 1
+            entry = await shield(future)
+            if entry is not None:
+                return entry.response()
+            # 处理器失败或响应不可缓存，自行执行
+            return await produce()
+
+        self.misses += 1
+        future = get_event_loop().create_future()
+        self._pending[key] = future
+        generation = self._generation
+        entry = None
+        try:
+            response = await produce()
+            if generation == self._generation:
+                entry = self.put(key, response, ttl)
+        finally:
+            del self._pending[key]
+            future.set_result(entry)
+        return response
+
+    def put(self, key, response, ttl):
+        """
+        缓存状态码为 200 且没有设置 cookie 的 HTTPResponse
+        :return: CacheEntry，不可缓存时返回 None
+        """
+        if type(response) is not HTTPResponse or response.status != 200 \
+                or response._cookies:
+            return None
+        entry = CacheEntry(response, monotonic() + ttl, self.add_etag)
+        if entry.size > self.max_memory:
+            return None
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self.memory += entry.size
+        self._evict()
+        return entry
+
+    def invalidate(self, prefix=''):
+        """
+        删除以 prefix 开头的缓存键，正在执行的处理器的结果不会被缓存
+        :param prefix: 键前缀，通常为路径，默认删除全部
+        :return: 删除的条目数
+        """
+        self._generation += 1
+        keys = [key for key in self._entries if key.startswith(prefix)]
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def stats(self):
+        """
+        返回统计信息
+        """
+        return CacheStats(
+            entries=len(self._entries), memory=self.memory,
+            hits=self.hits, misses=self.misses,
+            coalesced=self.coalesced, evictions=self.evictions)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.memory -= entry.size
+
+    def _evict(self):
+        entries = self._entries
+        while entries and (len(entries) > self.max_entries or
+                           self.memory > self.max_memory):
+            _, entry = entries.popitem(last=False)
+            self.memory -= entry.size
+            self.evictions += 1
+
+
+def cache(ttl, vary=None):
+    """
+    缓存路由响应的装饰器，与 `app.route` 一起使用：
+
+        @app.route('/')
+        @cache(ttl=60, vary=['Accept-Language'])
+        async def index(request):
+            ...
+
+    只缓存 GET 和 HEAD 请求的 200 响应，不缓存设置了 cookie 的响应
+    :param ttl: 以秒为单位，缓存有效时间
+    :param vary: 影响响应内容的请求头名称列表
+    """
+    def decorator(handler):
+        handler.cache_ttl = ttl
+        handler.cache_vary = tuple(vary) if vary else ()
+        return handler
+
+    return decorator
@@ -0,0 +1,109 @@
+import json as _json
+from asyncio import get_event_loop
+from collections import namedtuple
+
+import ujson
+
+# JSON 编解码器，dumps 可以返回 str 或 bytes
+JSONCodec = namedtuple('JSONCodec', ['name', 'loads', 'dumps'])
+
+# 已注册的编解码器
+CODECS = {
+    'ujson': JSONCodec('ujson', ujson.loads, ujson.dumps),
+    'json': JSONCodec('json', _json.loads,
+                      _json.JSONEncoder(separators=(',', ':')).encode),
+}
+
+try:
+    import orjson
+except ImportError:     # orjson 为可选依赖
+    pass
+else:
+    CODECS['orjson'] = JSONCodec('orjson', orjson.loads, orjson.dumps)
+
+_codec = CODECS['ujson']    # 当前使用的编解码器
+_offload_threshold = 0      # 超过此大小在线程池中编解码，0 为不使用线程池
+SAMPLE_KEYS = 8             # 估算大小时逐个计算的字典键数上限
+
+
+def register_codec(name, loads, dumps):
+    """
+    注册编解码器
+    :param name: 名称，对应配置中的 JSON_CODEC
+    :param loads: 接受 str 或 bytes，返回对象
+    :param dumps: 接受对象，返回 str 或 bytes
+    """
+    CODECS[name] = JSONCodec(name, loads, dumps)
+
+
+def use_codec(name, offload_threshold=0):
+    """
+    选择当前进程使用的编解码器，由 app.run 在启动服务器前调用
+    :param name: 已注册的编解码器名称
+    :param offload_threshold: 以字节为单位，超过此大小的 JSON 在线程池中
+                              编解码，0 为不使用线程池
+    """
+    global _codec, _offload_threshold
+    if name not in CODECS:
+        raise KeyError('JSON codec "{}" is not registered, available: {}'
+                       .format(name, ', '.join(sorted(CODECS))))
+    _codec = CODECS[name]
+    _offload_threshold = offload_threshold
+
+
+def loads(data):
+    """
+    在当前线程中解码
+    """
+    return _codec.loads(data)
+
+
+def dumps(obj):
+    """
+    在当前线程中编码，返回 bytes
+    """
+    data = _codec.dumps(obj)
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return data
+
+
+async def loads_async(data):
+    """
+    解码，数据超过阈值时在默认线程池中执行
+    """
+    if _offload_threshold and len(data) >= _offload_threshold:
+        return await get_event_loop().run_in_executor(
+            None, _codec.loads, data)
+    return _codec.loads(data)
+
+
+def estimate_size(obj):
+    """
+    粗略估算编码后的大小，不遍历全部内容：
+    列表按第一个元素推算，键较多的字典按第一个值推算
+    """
+    if isinstance(obj, (str, bytes)):
+        return len(obj) + 2
+    if isinstance(obj, (list, tuple)):
+        return len(obj) * (estimate_size(obj[0]) + 1) if obj else 2
+    if isinstance(obj, dict):
+        if len(obj) > SAMPLE_KEYS:
+            key, value = next(iter(obj.items()))
+            return len(obj) * (len(str(key)) + estimate_size(value) + 4)
+        return sum(len(str(key)) + estimate_size(value) + 4
+                   for key, value in obj.items()) + 2
+    return 8    # 数字、布尔值和 None
+
+
+async def dumps_async(obj, size_hint=None):
+    """
+    编码，结果超过阈值时在默认线程池中执行
+    :param size_hint: 以字节为单位，编码后的大小，`None` 时由 estimate_size 估算
+    """
+    if _offload_threshold:
+        if size_hint is None:
+            size_hint = estimate_size(obj)
+        if size_hint >= _offload_threshold:
+            return await get_event_loop().run_in_executor(None, dumps, obj)
+    return dumps(obj)
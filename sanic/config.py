@@ -1,4 +1,40 @@
 class Config:
     REQUEST_MAX_SIZE = 100000000  # 100 megababies
-    REQUEST_TIMEOUT = 60  # 60 seconds
-    ROUTER_CACHE_SIZE = 1024  # 路由缓存大小
\ No newline at end of file
+    KEEP_ALIVE_TIMEOUT = 5  # 两个请求之间连接空闲的超时时间
+    REQUEST_HEADER_TIMEOUT = 10  # 从收到第一个字节起读取完请求头的截止时间
+    REQUEST_MAX_HEADER_SIZE = 8192  # 请求行和请求头的总大小上限
+    REQUEST_MAX_HEADERS = 100  # 请求头数量上限
+    REQUEST_BODY_TIMEOUT = 60  # 两次收到消息体数据之间的超时时间
+    REQUEST_BODY_MIN_RATE = 1024  # 消息体最低传输速率，字节/秒，0 为不限制
+    REQUEST_BODY_RATE_PERIOD = 5  # 计算消息体传输速率的时间窗口，单位秒
+    RESPONSE_TIMEOUT = 60  # 处理器生成响应的超时时间
+    ROUTER_CACHE_SIZE = 1024  # 路由缓存大小
+    ROUTER_NEGATIVE_CACHE_SIZE = 1024  # 未匹配 URL 的缓存大小
+    ROUTER_CACHE_ROUTE_LIMIT = 64  # 单个动态路由最多占用的缓存条目数
+    REQUEST_BUFFER_QUEUE_SIZE = 100  # 流式请求缓存的数据块上限
+    REQUEST_MULTIPART_SPILL_SIZE = 1024 * 1024  # 表单文件超过此大小后写入磁盘临时文件
+    RESPONSE_AUTO_ETAG = True  # 为 GET 和 HEAD 请求的 200 响应按内容生成弱 ETag
+    ETAG_CACHE_SIZE = 1024  # 路由设置 etag_ttl 时缓存的 ETag 条目上限
+    RESPONSE_CACHE_MAX_ENTRIES = 1024  # `@cache` 路由缓存的响应条目上限
+    RESPONSE_CACHE_MAX_MEMORY = 64 * 1024 * 1024  # `@cache` 路由缓存占用的内存上限
+    JSON_CODEC = 'ujson'  # JSON 编解码器：ujson、json，安装后可使用 orjson
+    JSON_OFFLOAD_THRESHOLD = 0  # 超过此大小的 JSON 在线程池中编解码，0 为不使用线程池
+    REQUEST_PIPELINE_SIZE = 16  # 每个连接上等待响应的请求数上限
+    REQUEST_PIPELINE_CONCURRENCY = 1  # 每个连接上同时执行的处理器数
+    GRACEFUL_SHUTDOWN_TIMEOUT = 15  # 关闭服务器时等待请求处理完毕的最长时间
+    MAX_CONNECTIONS = 0  # 每个进程的连接数上限，超过后返回 503，0 为不限制
+    MAX_IN_FLIGHT_REQUESTS = 0  # 每个进程正在执行的处理器数上限，0 为不限制
+    SHED_QUEUE_TARGET = 0  # 请求排队时间目标值，持续超过后返回 503，单位秒，0 为关闭
+    SHED_QUEUE_INTERVAL = 0.1  # 判断排队时间的窗口，单位秒
+    OVERLOAD_RETRY_AFTER = 1  # 503 响应中的 Retry-After，单位秒
+    WORKER_MAX_REQUESTS = 0  # 工作进程处理的请求数上限，达到后重启，0 为不限制
+    WORKER_MAX_REQUESTS_JITTER = 0  # 请求数上限的随机增量，避免进程同时重启
+    WORKER_MAX_RSS = 0  # 工作进程的内存上限，单位字节，超过后重启，0 为不限制
+    WORKER_CHECK_INTERVAL = 1  # supervisor 检查工作进程的间隔，单位秒
+    WORKER_PRELOAD = True  # 在主进程中初始化应用后 fork 工作进程，共享内存
+    WORKER_REUSE_PORT = False  # 每个工作进程绑定独立的 SO_REUSEPORT 套接字
+    TCP_NODELAY = True  # 关闭 Nagle 算法
+    TCP_DEFER_ACCEPT = 0  # 客户端发送数据后才唤醒 accept 的等待秒数，0 为关闭
+    SO_KEEPALIVE = False  # 开启 TCP keepalive 探测
+    SOCKET_SEND_BUFFER = None  # 套接字发送缓冲区大小，None 使用系统默认值
+    SOCKET_RECEIVE_BUFFER = None  # 套接字接收缓冲区大小，None 使用系统默认值
\ No newline at end of file
@@ -106,7 +106,13 @@ class Cookie(dict):
 
     def encode(self, encoding):
         """
-        编码 cookie，将编码后的字符串放入 output
+        编码 cookie
+        """
+        return str(self).encode(encoding)
+
+    def __str__(self):
+        """
+        序列化 cookie，将各属性放入 output
         """
         output = ['%s=%s' % (self.key, _quote(self.value))]
         for key, value in self.items():
@@ -122,7 +128,7 @@ class Cookie(dict):
             else:
                 output.append('%s=%s' % (self._keys[key], value))
 
-        return "; ".join(output).encode(encoding)
+        return "; ".join(output)
 
 # ------------------------------------------------------------ #
 #  Header Trickery
@@ -138,3 +144,6 @@ class MultiHeader:
 
     def encode(self):
         return self.name.encode()
+
+    def __str__(self):
+        return self.name
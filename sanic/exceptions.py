@@ -34,6 +34,12 @@ class PayloadTooLarge(SanicException):
     """
     status_code = 413
 
+class ServiceUnavailable(SanicException):
+    """
+    服务暂不可用
+    """
+    status_code = 503
+
 class NotFound(SanicException):
     """
     无法找到目标
@@ -1,10 +1,13 @@
 from cgi import parse_header
-from collections import namedtuple
-from http.cookies import SimpleCookie
+from collections import deque, OrderedDict
+from http.cookies import Morsel, SimpleCookie
 from httptools import parse_url
-from urllib.parse import parse_qs
-from ujson import loads as json_loads
+from io import BytesIO
+from shutil import copyfileobj
+from tempfile import SpooledTemporaryFile
+from urllib.parse import parse_qs, unquote
 
+from sanic import codec
 from sanic.exceptions import InvalidUsage
 from sanic.log import log
 
@@ -14,6 +17,115 @@ DEFAULT_HTTP_CONTENT_TYPE = "application/octet-stream"
 # 若媒体类型仍未知，则将其作为默认类型 "application/octet-stream"
 
 
+# 常用请求头名称，查找时直接复用，避免重复解码
+COMMON_HEADER_NAMES = {
+    name.encode(): name for name in (
+        'host', 'content-type', 'content-length', 'cookie', 'authorization',
+        'accept', 'accept-encoding', 'accept-language', 'user-agent',
+        'connection', 'range', 'expect', 'transfer-encoding', 'referer',
+        'origin', 'if-none-match', 'if-modified-since', 'x-forwarded-for',
+    )
+}
+
+_MISSING = object()
+
+MULTIPART_MAX_HEADER_SIZE = 8192    # 表单每个部分的头部大小上限
+
+PARSE_CACHE_SIZE = 256          # 查询字符串和 Cookie 解析结果的缓存条目上限
+PARSE_CACHE_MAX_KEY = 1024      # 超过此长度的字符串不缓存
+
+# Cookie 属性名，出现在请求头中时不作为 cookie
+_COOKIE_RESERVED = frozenset(Morsel._reserved)
+
+
+def _decode_header_name(name):
+    """
+    请求头名称统一转为小写 str
+    """
+    name = name.lower()
+    return COMMON_HEADER_NAMES.get(name) or name.decode('latin-1')
+
+
+def _decode_header_value(value):
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+
+class RequestHeaders:
+    """
+    请求头，保存 httptools 解析出的原始 (bytes, bytes) 列表，
+    第一次查找时才建立大小写不敏感的索引，值在读取时解码。
+    """
+    __slots__ = ('_raw', '_index')
+
+    def __init__(self, raw):
+        self._raw = raw         # 原始请求头列表
+        self._index = None      # 小写名称 -> 原始值列表
+
+    def _get_index(self):
+        index = self._index
+        if index is None:
+            index = {}
+            for name, value in self._raw:
+                name = _decode_header_name(name)
+                if name in index:
+                    index[name].append(value)
+                else:
+                    index[name] = [value]
+            self._index = index
+        return index
+
+    def get(self, name, default=None):
+        """
+        返回指定请求头的第一个值
+        """
+        values = self._get_index().get(name.lower())
+        if values is None:
+            return default
+        return _decode_header_value(values[0])
+
+    def getall(self, name, default=_MISSING):
+        """
+        返回指定请求头的所有值
+        """
+        values = self._get_index().get(name.lower())
+        if values is None:
+            if default is _MISSING:
+                raise KeyError(name)
+            return default
+        return [_decode_header_value(value) for value in values]
+
+    def __getitem__(self, name):
+        value = self.get(name, _MISSING)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return name.lower() in self._get_index()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._raw)
+
+    def keys(self):
+        return [_decode_header_name(name) for name, _ in self._raw]
+
+    def values(self):
+        return [_decode_header_value(value) for _, value in self._raw]
+
+    def items(self):
+        return [(_decode_header_name(name), _decode_header_value(value))
+                for name, value in self._raw]
+
+    def __repr__(self):
+        return '<RequestHeaders {!r}>'.format(self.items())
+
+
 class RequestParameters(dict):
     """
     字典存储请求参数
@@ -28,34 +140,250 @@ class RequestParameters(dict):
         return super().get(name, default)
 
 
+def _immutable(self, *args, **kwargs):
+    raise TypeError('{} is immutable'.format(type(self).__name__))
+
+
+class ImmutableDict(dict):
+    """
+    只读字典，缓存的解析结果在多个请求间共享，不允许修改
+    """
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def copy(self):
+        return dict(self)
+
+
+class ImmutableRequestParameters(ImmutableDict, RequestParameters):
+    """
+    只读的请求参数，值为 tuple，`getlist` 返回 list 副本
+    """
+    __slots__ = ()
+
+    def getlist(self, name, default=None):
+        values = dict.get(self, name)
+        if values is None:
+            return default
+        return list(values)
+
+    def copy(self):
+        return RequestParameters(
+            (name, list(values)) for name, values in self.items())
+
+
+EMPTY_PARAMETERS = ImmutableRequestParameters()
+EMPTY_COOKIES = ImmutableDict()
+
+
+def _memoize(parse):
+    """
+    以原始字符串为键，将解析结果缓存在有界 LRU 中，每个工作进程一份
+    """
+    cache = OrderedDict()
+
+    def wrapper(raw):
+        result = cache.get(raw)
+        if result is not None:
+            cache.move_to_end(raw)
+            return result
+        result = parse(raw)
+        if len(raw) <= PARSE_CACHE_MAX_KEY:
+            cache[raw] = result
+            if len(cache) > PARSE_CACHE_SIZE:
+                cache.popitem(last=False)
+        return result
+
+    wrapper.cache = cache
+    wrapper.__wrapped__ = parse
+    wrapper.__doc__ = parse.__doc__
+    return wrapper
+
+
+@_memoize
+def parse_query_string(query_string):
+    """
+    解析查询字符串，与 `parse_qs` 的默认行为一致：以 `&` 分隔，
+    忽略没有值的参数，`+` 视为空格；只有含 `%` 或 `+` 时才解码
+    :return: ImmutableRequestParameters
+    """
+    params = {}
+    for field in query_string.split('&'):
+        name, eq, value = field.partition('=')
+        if not value:
+            continue
+        if '+' in name:
+            name = name.replace('+', ' ')
+        if '%' in name:
+            name = unquote(name, errors='replace')
+        if '+' in value:
+            value = value.replace('+', ' ')
+        if '%' in value:
+            value = unquote(value, errors='replace')
+        values = params.get(name)
+        if values is None:
+            params[name] = (value,)
+        else:
+            params[name] = values + (value,)
+    return ImmutableRequestParameters(params)
+
+
+@_memoize
+def parse_cookie(cookie):
+    """
+    解析 `Cookie` 请求头，同名 cookie 以最后一个为准。
+    带引号的值中可能含有 `;`，这类请求头交给 `SimpleCookie` 解析
+    :return: ImmutableDict
+    """
+    if '"' in cookie:
+        cookies = SimpleCookie()
+        cookies.load(cookie)
+        return ImmutableDict(
+            (name, morsel.value) for name, morsel in cookies.items())
+
+    cookies = {}
+    for item in cookie.split(';'):
+        name, eq, value = item.partition('=')
+        name = name.strip()
+        if not eq or not name or name.lower() in _COOKIE_RESERVED:
+            continue
+        cookies[name] = value.strip()
+    return ImmutableDict(cookies)
+
+
+class StreamBuffer:
+    """
+    流式请求消息体，处理器通过 `async for chunk in request.stream` 逐块读取。
+    缓存的数据块达到上限时暂停读取 transport，处理器消费到一半以下时恢复读取。
+    """
+    __slots__ = ('_loop', '_transport', '_buffer', '_maxsize',
+                 '_waiter', '_eof', '_paused')
+
+    def __init__(self, loop, transport, maxsize=100):
+        self._loop = loop
+        self._transport = transport
+        self._buffer = deque()          # 待读取的数据块
+        self._maxsize = maxsize         # 缓存数据块上限
+        self._waiter = None             # 等待数据的 future
+        self._eof = False               # 消息体是否接收完毕
+        self._paused = False            # transport 是否已暂停读取
+
+    @property
+    def at_eof(self):
+        """
+        消息体已接收完毕且全部被读取
+        """
+        return self._eof and not self._buffer
+
+    @property
+    def pending(self):
+        """
+        等待处理器读取的数据块数
+        """
+        return len(self._buffer)
+
+    def put(self, data):
+        """
+        写入数据块，由协议在 on_body 中调用
+        """
+        self._buffer.append(data)
+        self._wakeup()
+        if not self._paused and len(self._buffer) >= self._maxsize:
+            self._paused = True
+            self._transport.pause_reading()
+
+    def feed_eof(self):
+        """
+        标记消息体结束
+        """
+        self._eof = True
+        self._wakeup()
+
+    def resume(self):
+        """
+        恢复读取 transport
+        """
+        if self._paused:
+            self._paused = False
+            self._transport.resume_reading()
+
+    def _wakeup(self):
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def read(self):
+        """
+        读取下一个数据块，消息体结束时返回 None
+        """
+        while not self._buffer:
+            if self._eof:
+                return None
+            self._waiter = self._loop.create_future()
+            await self._waiter
+
+        data = self._buffer.popleft()
+        if self._paused and len(self._buffer) <= self._maxsize // 2:
+            self.resume()
+        return data
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.read()
+        if data is None:
+            raise StopAsyncIteration
+        return data
+
+
 class Request(dict):
     """一个 HTTP 请求的属性，包括 URL, headers 等"""
 
     # 插槽，阻止动态创建属性
     __slots__ = (
-        'url', 'headers', 'version', 'method', '_cookies',
-        'query_string', 'body',
+        'url', 'headers', 'version', 'method', 'transport', '_cookies',
+        'query_string', 'body', 'stream', 'multipart',
         'parsed_json', 'parsed_args', 'parsed_form', 'parsed_files',
     )
 
-    def __init__(self, url_bytes, headers, version, method):
+    def __init__(self, url_bytes, headers, version, method, transport=None):
         url_parsed = parse_url(url_bytes)
         self.url = url_parsed.path.decode('utf-8')
         self.headers = headers
         self.version = version
         self.method = method
+        self.transport = transport
         self.query_string = None
         if url_parsed.query:
             self.query_string = url_parsed.query.decode('utf-8')
 
         # Init but do not inhale
-        self.body = None
+        self.body = []      # 消息体数据块，接收完毕后合并为 bytes，流式路由为 b''
+        self.stream = None  # 流式路由的消息体
+        self.multipart = None   # 增量解析 multipart 表单的解析器
         self.parsed_json = None
         self.parsed_form = None
         self.parsed_files = None
         self.parsed_args = None
         self._cookies = None
 
+    def body_push(self, data):
+        """
+        追加消息体数据块
+        """
+        self.body.append(data)
+
+    def body_finish(self):
+        """
+        消息体接收完毕，一次性合并所有数据块
+        """
+        self.body = b''.join(self.body)
+
     @property
     def json(self):
         """
@@ -63,12 +391,36 @@ class Request(dict):
         """
         if self.parsed_json is None:
             try:
-                self.parsed_json = json_loads(self.body)
+                self.parsed_json = codec.loads(self.body)
             except Exception:   # 无效用法
                 raise InvalidUsage("Failed when parsing body as json")
 
         return self.parsed_json
 
+    async def load_json(self):
+        """
+        与 `json` 相同，消息体超过 JSON_OFFLOAD_THRESHOLD 时在线程池中解码
+        """
+        if self.parsed_json is None:
+            try:
+                self.parsed_json = await codec.loads_async(self.body)
+            except Exception:
+                raise InvalidUsage("Failed when parsing body as json")
+
+        return self.parsed_json
+
+    @property
+    def remote_addr(self):
+        """
+        返回客户端地址 `host:port`，只在访问时读取
+        """
+        peername = None
+        if self.transport is not None:
+            peername = self.transport.get_extra_info('peername')
+        if not peername:
+            return None
+        return '%s:%s' % peername[:2]
+
     @property
     def token(self):
         """
@@ -95,9 +447,13 @@ class Request(dict):
                     self.parsed_form = RequestParameters(
                         parse_qs(self.body.decode('utf-8')))
                 elif content_type == 'multipart/form-data': # POST 方式提交表单
-                    boundary = parameters['boundary'].encode('utf-8')
-                    self.parsed_form, self.parsed_files = (
-                        parse_multipart_form(self.body, boundary))  # 此解析方法后面实现
+                    if self.multipart is not None:  # 接收消息体时已解析
+                        self.parsed_form, self.parsed_files = \
+                            self.multipart.result()
+                    else:
+                        boundary = parameters['boundary'].encode('utf-8')
+                        self.parsed_form, self.parsed_files = (
+                            parse_multipart_form(self.body, boundary))
             except Exception:
                 log.exception("Failed when parsing form")   # 日志记录异常信息
 
@@ -112,31 +468,256 @@ class Request(dict):
 
     @property
     def args(self):
+        """
+        查询参数，只读，相同的查询字符串共享解析结果
+        """
         if self.parsed_args is None:
             if self.query_string:
-                self.parsed_args = RequestParameters(
-                    parse_qs(self.query_string))
+                self.parsed_args = parse_query_string(self.query_string)
             else:
-                self.parsed_args = {}
+                self.parsed_args = EMPTY_PARAMETERS
 
         return self.parsed_args
 
     @property
     def cookies(self):
+        """
+        cookie 字典，只读，相同的 Cookie 请求头共享解析结果
+        """
         if self._cookies is None:
-            cookie = self.headers.get('Cookie') or self.headers.get('cookie')
+            cookie = self.headers.get('Cookie')
             if cookie is not None:
-                cookies = SimpleCookie()
-                cookies.load(cookie)
-                self._cookies = {name: cookie.value
-                                 for name, cookie in cookies.items()}
+                self._cookies = parse_cookie(cookie)
             else:
-                self._cookies = {}
+                self._cookies = EMPTY_COOKIES
         return self._cookies
 
 
-# 定义文件为 namedtuple
-File = namedtuple('File', ['type', 'body', 'name'])
+class File:
+    """
+    表单中上传的文件，内容保存在 SpooledTemporaryFile 中，
+    超过阈值的文件位于磁盘临时文件。可以像文件对象一样 read、seek 等
+    """
+    __slots__ = ('type', 'name', 'file')
+
+    def __init__(self, type, name, file):
+        self.type = type    # 媒体类型
+        self.name = name    # 文件名
+        self.file = file    # 文件内容
+
+    @property
+    def body(self):
+        """
+        一次性读取全部内容
+        """
+        self.file.seek(0)
+        return self.file.read()
+
+    def save(self, path):
+        """
+        将内容写入指定路径
+        """
+        self.file.seek(0)
+        with open(path, 'wb') as f:
+            copyfileobj(self.file, f)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __repr__(self):
+        return '<File name={!r} type={!r}>'.format(self.name, self.type)
+
+
+# 解析状态
+_PREAMBLE, _DELIMITER, _HEADERS, _BODY, _END = range(5)
+
+
+class MultipartParser:
+    """
+    增量解析 multipart/form-data 消息体，由协议在 on_body 中逐块写入。
+    在滚动的缓冲区中查找分隔符，未找到时只保留可能是分隔符开头的尾部，
+    其余数据直接写入当前部分；普通字段保存在内存中，文件写入
+    SpooledTemporaryFile，超过阈值后转存到磁盘。
+    解析出错时记录异常并丢弃后续数据，在读取结果时抛出。
+    """
+    __slots__ = ('_delimiter', '_buffer', '_state', '_spill_size',
+                 '_name', '_filename', '_type', '_sink',
+                 '_fields', '_files', 'error')
+
+    def __init__(self, boundary, spill_size=1024 * 1024):
+        """
+        :param boundary: 分隔符，bytes
+        :param spill_size: 文件超过此大小后写入磁盘临时文件
+        """
+        self._delimiter = b'\r\n--' + boundary
+        # 第一个分隔符前没有 CRLF，补上后统一查找 `CRLF--boundary`
+        self._buffer = bytearray(b'\r\n')
+        self._state = _PREAMBLE
+        self._spill_size = spill_size
+        self._name = None           # 当前部分的字段名
+        self._filename = None       # 当前部分的文件名
+        self._type = None           # 当前部分的媒体类型
+        self._sink = None           # 当前部分的内容，BytesIO 或临时文件
+        self._fields = RequestParameters()
+        self._files = RequestParameters()
+        self.error = None           # 解析时发生的异常
+
+    def feed(self, data):
+        """
+        写入消息体数据块
+        """
+        if self._state == _END:     # 结束分隔符之后的内容忽略
+            return
+        self._buffer += data
+        try:
+            self._parse()
+        except Exception as e:
+            self._fail(e)
+
+    def feed_eof(self):
+        """
+        消息体接收完毕
+        """
+        if self._state != _END:
+            self._fail(InvalidUsage('Incomplete multipart body'))
+
+    def result(self):
+        """
+        返回解析出的字段和文件
+        :return: (fields, files)
+        """
+        if self.error is not None:
+            raise self.error
+        return self._fields, self._files
+
+    def _fail(self, exception):
+        self.error = exception
+        self._state = _END
+        self._buffer = None
+        if self._sink is not None:
+            self._sink.close()
+        self._sink = None
+
+    def _parse(self):
+        buffer = self._buffer
+        delimiter = self._delimiter
+        # 未找到分隔符时保留的尾部长度
+        keep = len(delimiter) - 1
+
+        while True:
+            state = self._state
+            if state == _BODY:
+                index = buffer.find(delimiter)
+                if index < 0:
+                    size = len(buffer) - keep
+                    if size > 0:
+                        self._sink.write(buffer[:size])
+                        del buffer[:size]
+                    return
+                self._sink.write(buffer[:index])
+                del buffer[:index + len(delimiter)]
+                self._finish_part()
+                self._state = _DELIMITER
+
+            elif state == _DELIMITER:
+                # 分隔符后为 `--` 表示结束，否则跳过到行尾
+                if len(buffer) < 2:
+                    return
+                if buffer[:2] == b'--':
+                    self._state = _END
+                    buffer.clear()
+                    return
+                index = buffer.find(b'\r\n')
+                if index < 0:
+                    if len(buffer) > MULTIPART_MAX_HEADER_SIZE:
+                        raise InvalidUsage('Invalid multipart delimiter')
+                    return
+                del buffer[:index + 2]
+                self._state = _HEADERS
+
+            elif state == _HEADERS:
+                if buffer[:2] == b'\r\n':  # 没有头部
+                    index = -2
+                else:
+                    index = buffer.find(b'\r\n\r\n')
+                    if index < 0:
+                        if len(buffer) > MULTIPART_MAX_HEADER_SIZE:
+                            raise InvalidUsage(
+                                'Multipart headers too large')
+                        return
+                self._start_part(buffer[:max(index, 0)])
+                del buffer[:index + 4]
+                self._state = _BODY
+
+            elif state == _PREAMBLE:
+                index = buffer.find(delimiter)
+                if index < 0:   # 丢弃前导内容
+                    if len(buffer) > keep:
+                        del buffer[:-keep]
+                    return
+                del buffer[:index + len(delimiter)]
+                self._state = _DELIMITER
+
+            else:
+                return
+
+    def _start_part(self, header_block):
+        """
+        解析部分的头部，创建保存内容的对象
+        """
+        self._name = self._filename = self._type = None
+        for line in header_block.decode('utf-8').split('\r\n'):
+            field, _, value = line.partition(':')
+            field = field.strip().lower()
+            value, parameters = parse_header(value.strip())
+            if field == 'content-disposition':
+                self._name = parameters.get('name')
+                self._filename = parameters.get('filename')
+            elif field == 'content-type':
+                self._type = value
+
+        if self._filename or self._type:
+            self._sink = SpooledTemporaryFile(max_size=self._spill_size)
+        else:
+            self._sink = BytesIO()
+
+    def _finish_part(self):
+        """
+        当前部分读取完毕，加入字段或文件
+        """
+        sink = self._sink
+        self._sink = None
+        if isinstance(sink, BytesIO):
+            target = self._fields
+            value = sink.getvalue().decode('utf-8')    # 非文件类型数据
+        else:
+            sink.seek(0)
+            target = self._files
+            value = File(type=self._type, name=self._filename, file=sink)
+
+        if self._name in target:
+            target[self._name].append(value)
+        else:
+            target[self._name] = [value]
+
+
+def create_multipart_parser(content_type, spill_size):
+    """
+    根据原始的 Content-Type 请求头创建解析器
+    :param content_type: bytes 类型的请求头值
+    :param spill_size: 文件超过此大小后写入磁盘临时文件
+    :return: MultipartParser，不是 multipart/form-data 或缺少分隔符时返回 None
+    """
+    if content_type[:19].lower() != b'multipart/form-data':
+        return None
+    content_type, parameters = parse_header(content_type.decode('latin-1'))
+    boundary = parameters.get('boundary')
+    if content_type != 'multipart/form-data' or not boundary:
+        return None
+    return MultipartParser(boundary.encode('latin-1'), spill_size)
 
 
 def parse_multipart_form(body, boundary):
@@ -145,48 +726,7 @@ def parse_multipart_form(body, boundary):
     :param body: 请求消息体
     :param boundary: 分隔符
     """
-    files = RequestParameters() # 文件
-    fields = RequestParameters()    # 文件域
-
-    form_parts = body.split(boundary)
-    for form_part in form_parts[1:-1]:
-        file_name = None    # 文件名
-        file_type = None    # 文件类型
-        field_name = None   # 文件域
-        line_index = 2
-        line_end_index = 0
-        while not line_end_index == -1:
-            line_end_index = form_part.find(b'\r\n', line_index)
-            form_line = form_part[line_index:line_end_index].decode('utf-8')
-            line_index = line_end_index + 2
-
-            if not form_line:
-                break
-
-            colon_index = form_line.index(':')
-            form_header_field = form_line[0:colon_index]
-            form_header_value, form_parameters = parse_header(
-                form_line[colon_index + 2:])
-
-            if form_header_field == 'Content-Disposition':
-                if 'filename' in form_parameters:
-                    file_name = form_parameters['filename']
-                field_name = form_parameters.get('name')
-            elif form_header_field == 'Content-Type':
-                file_type = form_header_value
-
-        post_data = form_part[line_index:-4]    # POST 提交数据
-        if file_name or file_type:
-            file = File(type=file_type, name=file_name, body=post_data) # 创建文件
-            if field_name in files:
-                files[field_name].append(file)
-            else:
-                files[field_name] = [file]
-        else:
-            value = post_data.decode('utf-8')   # 非文件类型数据
-            if field_name in fields:
-                fields[field_name].append(value)
-            else:
-                fields[field_name] = [value]
-
-    return fields, files
+    parser = MultipartParser(boundary)
+    parser.feed(body)
+    parser.feed_eof()
+    return parser.result()
@@ -1,10 +1,11 @@
-from os import path
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from hashlib import blake2b
+from os import path, stat
 from mimetypes import guess_type
+from time import time
 from urllib.parse import quote_plus
 
-from aiofiles import open as open_async
-from ujson import dumps as json_dumps
-
+from sanic import codec
 from sanic.cookies import CookieJar
 
 # 全部状态码
@@ -69,7 +70,277 @@ ALL_STATUS_CODES = {
 }
 
 
-class HTTPResponse:
+# 序列化头部时使用的缓存
+_HEAD_LINES = {}            # (version, status, content_type) -> 状态行和 Content-Type 行
+_CONNECTION_LINES = {}      # keep_alive_timeout -> Connection 和 Keep-Alive 行
+_HEADER_CACHE_SIZE = 256    # 每个缓存的条目上限
+_date_line = None           # Date 行，由服务器每秒刷新
+
+# 304 响应中保留的头部
+NOT_MODIFIED_HEADERS = (
+    'ETag', 'Last-Modified', 'Cache-Control', 'Content-Location',
+    'Expires', 'Vary')
+
+
+def update_date(now):
+    """
+    刷新缓存的 Date 头部，由 server 的 update_current_time 每秒调用
+    """
+    global _date_line
+    _date_line = b'Date: %b\r\n' % formatdate(now, usegmt=True).encode()
+    return _date_line
+
+
+def _build_head_line(key):
+    """
+    生成并缓存状态行和 Content-Type 行
+    """
+    version, status, content_type = key
+    line = b'HTTP/%b %d %b\r\nContent-Type: %b\r\n' % (
+        version.encode(), status, ALL_STATUS_CODES.get(status, b'UNKNOWN'),
+        content_type.encode())
+    if len(_HEAD_LINES) < _HEADER_CACHE_SIZE:
+        _HEAD_LINES[key] = line
+    return line
+
+
+def _build_connection_line(keep_alive_timeout):
+    """
+    生成并缓存保持连接时的 Connection 和 Keep-Alive 行
+    """
+    line = b'Connection: keep-alive\r\n'
+    if keep_alive_timeout:
+        line += b'Keep-Alive: timeout=%d\r\n' % keep_alive_timeout
+    if len(_CONNECTION_LINES) < _HEADER_CACHE_SIZE:
+        _CONNECTION_LINES[keep_alive_timeout] = line
+    return line
+
+
+class BaseHTTPResponse:
+    """
+    响应基类，实现头部序列化与 cookie
+    """
+    __slots__ = ()
+
+    def _encode_body(self, data):
+        """
+        将响应内容编码为 bytes
+        """
+        try:
+            return data.encode('utf-8')     # 默认编码
+        except AttributeError:
+            return str(data).encode('utf-8')    # 异常编码，尝试转换成字符串
+
+    def _parse_headers(self):
+        """
+        序列化自定义头部
+        """
+        # 先拼接为 str 再统一编码，非字符串的值通过 %s 转换
+        return ''.join(['%s: %s\r\n' % (name, value)
+                        for name, value in self.headers.items()]
+                       ).encode('utf-8')
+
+    def _serialize_headers(self, version, keep_alive, keep_alive_timeout,
+                           length_line, body=b''):
+        """
+        拼接状态行、全部头部和响应内容，固定部分从缓存中读取
+        :param length_line: Content-Length 或 Transfer-Encoding 等头部行
+        """
+        key = (version, self.status, self.content_type)
+        head_line = _HEAD_LINES.get(key) or _build_head_line(key)
+
+        if keep_alive:
+            connection_line = _CONNECTION_LINES.get(keep_alive_timeout) or \
+                _build_connection_line(keep_alive_timeout)
+        else:
+            connection_line = b'Connection: close\r\n'
+
+        return b'%b%b%b%b%b\r\n%b' % (
+            head_line,                                  # 状态行和内容格式
+            length_line,                                # 内容长度
+            connection_line,                            # 连接状态
+            _date_line or update_date(time()),          # 日期
+            self._parse_headers() if self.headers else b'',  # 自定义头部
+            body,                                       # 响应内容
+        )
+
+    # 返回 cookie 部分
+    @property
+    def cookies(self):
+        if self._cookies is None:
+            self._cookies = CookieJar(self.headers)
+        return self._cookies
+
+
+class StreamingHTTPResponse(BaseHTTPResponse):
+    """
+    流式响应，以 `Transfer-Encoding: chunked` 分块发送响应内容。
+    streaming_fn 可以是异步迭代器，也可以是接收 response 的协程函数，
+    在函数中调用 `await response.write(data)` 写入数据。
+    """
+    __slots__ = (
+        'protocol', 'streaming_fn', 'status',
+        'content_type', 'headers', '_cookies', 'chunked')
+
+    def __init__(self, streaming_fn, status=200, headers=None,
+                 content_type='text/plain'):
+        self.content_type = content_type    # 内容类型
+        self.streaming_fn = streaming_fn    # 生成响应内容的函数
+        self.status = status                # 状态码
+        self.headers = headers or {}        # 头部
+        self._cookies = None                # cookie 内容
+        self.protocol = None                # 写入数据的 HttpProtocol
+        self.chunked = True                 # 是否分块编码
+
+    async def write(self, data):
+        """
+        写入一块响应内容，写缓冲区超过高水位时等待其回落
+        """
+        if type(data) is not bytes:
+            data = self._encode_body(data)
+        if not data:
+            return
+
+        if self.chunked:
+            data = b'%x\r\n%b\r\n' % (len(data), data)
+        self.protocol.push_data(data)
+        await self.protocol.drain()
+
+    async def stream(self, request, keep_alive=False,
+                     keep_alive_timeout=None):
+        """
+        发送头部后依次写入响应内容
+        :return: 响应后是否保持连接
+        """
+        version = request.version
+        # HTTP/1.0 不支持分块编码，以关闭连接标识响应结束
+        self.chunked = version != '1.0'
+        keep_alive = keep_alive and self.chunked
+        self.protocol.push_data(
+            self.get_headers(version, keep_alive, keep_alive_timeout))
+        await self.protocol.drain()
+
+        if hasattr(self.streaming_fn, '__aiter__'):
+            async for data in self.streaming_fn:
+                await self.write(data)
+        else:
+            await self.streaming_fn(self)
+
+        if self.chunked:
+            self.protocol.push_data(b'0\r\n\r\n')
+        return keep_alive
+
+    def get_headers(self, version="1.1", keep_alive=False,
+                    keep_alive_timeout=None):
+        """
+        返回流式响应的头部
+        """
+        return self._serialize_headers(
+            version, keep_alive, keep_alive_timeout,
+            b'Transfer-Encoding: chunked\r\n' if self.chunked else b'')
+
+
+class FileHTTPResponse(BaseHTTPResponse):
+    """
+    文件响应，发送头部后通过 sendfile 由内核直接传输文件内容，
+    支持单个 `Range` 区间的 206 Partial Content 响应。
+    """
+    __slots__ = (
+        'protocol', 'location', 'size', 'file', 'status',
+        'content_type', 'headers', '_cookies')
+
+    def __init__(self, location, size, status=200, headers=None,
+                 content_type='text/plain', file=None):
+        self.location = location            # 文件路径
+        self.size = size                    # 文件大小
+        self.file = file                    # 已打开的文件对象，由调用方管理
+        self.content_type = content_type    # 内容类型
+        self.status = status                # 状态码
+        self.headers = headers or {}        # 头部
+        self._cookies = None                # cookie 内容
+        self.protocol = None                # 写入数据的 HttpProtocol
+
+    async def stream(self, request, keep_alive=False,
+                     keep_alive_timeout=None):
+        """
+        发送头部和文件内容，HEAD 请求只发送头部
+        :return: 响应后是否保持连接
+        """
+        version = request.version
+        offset, length = 0, self.size
+        range_header = request.headers.get('Range')
+        if range_header and self.status == 200:
+            try:
+                byte_range = parse_byte_range(range_header, self.size)
+            except ValueError:
+                # 区间无法满足
+                self.status = 416
+                self.headers['Content-Range'] = 'bytes */%d' % self.size
+                self.protocol.push_data(self.get_headers(
+                    0, version, keep_alive, keep_alive_timeout))
+                return keep_alive
+            if byte_range is not None:
+                start, end = byte_range
+                offset, length = start, end - start + 1
+                self.status = 206
+                self.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                    start, end, self.size)
+
+        self.protocol.push_data(self.get_headers(
+            length, version, keep_alive, keep_alive_timeout))
+        if not length or request.method == 'HEAD':
+            pass
+        elif self.file is not None:
+            await self.protocol.sendfile(self.file, offset, length)
+        else:
+            with open(self.location, 'rb') as _file:
+                await self.protocol.sendfile(_file, offset, length)
+        return keep_alive
+
+    def get_headers(self, content_length, version="1.1", keep_alive=False,
+                    keep_alive_timeout=None):
+        """
+        返回文件响应的头部
+        """
+        return self._serialize_headers(
+            version, keep_alive, keep_alive_timeout,
+            b'Content-Length: %d\r\nAccept-Ranges: bytes\r\n'
+            % content_length)
+
+
+def parse_byte_range(header, size):
+    """
+    解析 `Range` 请求头，只支持单个区间，多区间或格式错误时忽略
+    :param header: `Range` 头部的值，如 `bytes=0-499`
+    :param size: 文件大小
+    :return: (start, end) 闭区间，None 表示忽略该头部
+    :raise ValueError: 区间无法满足
+    """
+    unit, _, byte_range = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in byte_range:
+        return None
+    start, sep, end = byte_range.strip().partition('-')
+    if not sep or not (start or end) or \
+            not (start == '' or start.isdigit()) or \
+            not (end == '' or end.isdigit()):
+        return None
+
+    if not start:   # 后缀区间，如 `bytes=-500`
+        suffix = int(end)
+        if suffix == 0 or size == 0:
+            raise ValueError(header)
+        return max(size - suffix, 0), size - 1
+
+    start = int(start)
+    if start >= size:
+        raise ValueError(header)
+    end = int(end) if end else size - 1
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+class HTTPResponse(BaseHTTPResponse):
     __slots__ = ('body', 'status', 'content_type', 'headers', '_cookies')
 
     def __init__(self, body=None, status=200, headers=None,
@@ -77,10 +348,7 @@ class HTTPResponse:
         self.content_type = content_type    # 内容类型
 
         if body is not None:
-            try:
-                self.body = body.encode('utf-8')    # 默认编码
-            except AttributeError:
-                self.body = str(body).encode('utf-8')   # 异常编码，尝试转换成字符串
+            self.body = self._encode_body(body)
         else:
             self.body = body_bytes
 
@@ -88,58 +356,41 @@ class HTTPResponse:
         self.headers = headers or {}    # 头部
         self._cookies = None            # cookie 内容
 
+    def get_headers(self, version="1.1", keep_alive=False,
+                    keep_alive_timeout=None):
+        """
+        返回响应的状态行和头部
+        """
+        return self._serialize_headers(
+            version, keep_alive, keep_alive_timeout,
+            b'Content-Length: %d\r\n' % len(self.body)
+            if self.status != 304 else b'')
+
     def output(self, version="1.1", keep_alive=False, keep_alive_timeout=None):
         """
         返回一个标准的 HTTP 响应
         """
-        timeout_header = b''
-        if keep_alive and keep_alive_timeout: # 存活时间
-            timeout_header = b'Keep-Alive: timeout=%d\r\n' % keep_alive_timeout
-
-        headers = b''
-        if self.headers:    # 头部信息
-            for name, value in self.headers.items():
-                try:
-                    headers += (
-                        b'%b: %b\r\n' % (name.encode(), value.encode('utf-8')))
-                except AttributeError:
-                    headers += (
-                        b'%b: %b\r\n' % (
-                            str(name).encode(), str(value).encode('utf-8')))
-
-        status = ALL_STATUS_CODES.get(self.status)  # 获得状态码及其相应文本信息
-
-        # 规范格式返回响应
-        return (b'HTTP/%b %d %b\r\n'
-                b'Content-Type: %b\r\n'
-                b'Content-Length: %d\r\n'
-                b'Connection: %b\r\n'
-                b'%b%b\r\n'
-                b'%b') % (
-            version.encode(),           # HTTP 协议版本号
-            self.status,                # HTTP 状态码
-            status,                     # HTTP 状态码信息
-            self.content_type.encode(), # HTTP 内容格式
-            len(self.body),             # HTTP 内容长度
-            b'keep-alive' if keep_alive else b'close',  # HTTP 连接状态
-            timeout_header,             # 超时头部
-            headers,                    # 头部
-            self.body                   # HTTP 响应内容部分
-        )
-
-    # 返回 cookie 部分
-    @property
-    def cookies(self):
-        if self._cookies is None:
-            self._cookies = CookieJar(self.headers)
-        return self._cookies
+        if self.status == 304:  # 304 没有消息体，也不发送 Content-Length
+            return self._serialize_headers(
+                version, keep_alive, keep_alive_timeout, b'')
+        return self._serialize_headers(
+            version, keep_alive, keep_alive_timeout,
+            b'Content-Length: %d\r\n' % len(self.body), self.body)
 
 # HTTP 响应模块对外接口，根据 content_type 字段类型区分
 
 # 返回 json 格式内容的 HTTP 响应
 def json(body, status=200, headers=None):
-    return HTTPResponse(json_dumps(body), headers=headers, status=status,
-                        content_type="application/json")
+    return HTTPResponse(headers=headers, status=status,
+                        content_type="application/json",
+                        body_bytes=codec.dumps(body))
+
+# 返回 json 格式内容的 HTTP 响应，估算大小超过 JSON_OFFLOAD_THRESHOLD 时在线程池中编码，
+# size_hint 可以代替估算值
+async def json_async(body, status=200, headers=None, size_hint=None):
+    return HTTPResponse(headers=headers, status=status,
+                        content_type="application/json",
+                        body_bytes=await codec.dumps_async(body, size_hint))
 
 # 返回 text 格式内容的 HTTP 响应
 def text(body, status=200, headers=None):
@@ -154,25 +405,35 @@ def html(body, status=200, headers=None):
 # 返回 file 格式内容的 HTTP 响应
 async def file(location, mime_type=None, headers=None):
     """
-    文件下载，通过 body_bytes 参数传递文件数据流
-    异步实现：
-        - 异步打开文件
-        - 异步读取文件
+    文件下载，文件内容在写入响应时通过 sendfile 发送，不读入内存
     """
     filename = path.split(location)[-1]
-
-    # 异步打开文件
-    async with open_async(location, mode='rb') as _file:
-        # 异步读取文件
-        out_stream = await _file.read()
+    stats = stat(location)
 
     # 文件类型
     mime_type = mime_type or guess_type(filename)[0] or 'text/plain'
 
-    return HTTPResponse(status=200,
-                        headers=headers,
-                        content_type=mime_type,
-                        body_bytes=out_stream)
+    # 验证器，条件请求在打开文件之前比较
+    headers = dict(headers) if headers else {}
+    headers.setdefault('ETag', 'W/"%x-%x"' % (stats.st_size,
+                                              stats.st_mtime_ns))
+    headers.setdefault('Last-Modified',
+                       formatdate(stats.st_mtime, usegmt=True))
+
+    return FileHTTPResponse(location, stats.st_size,
+                            headers=headers,
+                            content_type=mime_type)
+
+# 返回流式 HTTP 响应
+def stream(streaming_fn, status=200, headers=None,
+           content_type="text/plain; charset=utf-8"):
+    """
+    流式响应，分块发送响应内容
+    :param streaming_fn: 异步迭代器，或接收 response 并调用
+                         `await response.write(data)` 的协程函数
+    """
+    return StreamingHTTPResponse(streaming_fn, status=status,
+                                 headers=headers, content_type=content_type)
 
 # 重定向页面
 def redirect(to, headers=None, status=302,
@@ -193,3 +454,66 @@ def redirect(to, headers=None, status=302,
         status=status,
         headers=headers,
         content_type=content_type)
+
+
+# -------------------------------------------------------------------- #
+# 条件请求
+# -------------------------------------------------------------------- #
+
+def make_etag(body):
+    """
+    根据响应内容生成弱 ETag
+    :param body: bytes 类型的响应内容
+    """
+    return 'W/"%x-%s"' % (len(body), blake2b(body, digest_size=8).hexdigest())
+
+
+def etag_matches(if_none_match, etag):
+    """
+    按弱比较判断 `If-None-Match` 是否包含指定的 ETag
+    """
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    if etag not in if_none_match:
+        return if_none_match.strip() == '*'
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def is_not_modified(headers, etag=None, last_modified=None):
+    """
+    判断条件请求是否可以返回 304，`If-None-Match` 存在时忽略 `If-Modified-Since`
+    :param headers: 请求头
+    :param etag: 响应的 ETag
+    :param last_modified: 响应的 `Last-Modified`
+    """
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag is not None and etag_matches(if_none_match, etag)
+
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since is None or last_modified is None:
+        return False
+    if if_modified_since == last_modified:  # 客户端通常原样返回
+        return True
+    since = parsedate_tz(if_modified_since)
+    modified = parsedate_tz(last_modified)
+    if since is None or modified is None:
+        return False
+    return mktime_tz(modified) <= mktime_tz(since)
+
+
+def not_modified(headers=None):
+    """
+    返回没有消息体的 304 响应，只保留验证器和缓存相关的头部
+    :param headers: 原响应的头部
+    """
+    if headers:
+        headers = {name: headers[name] for name in NOT_MODIFIED_HEADERS
+                   if name in headers}
+    return HTTPResponse(status=304, headers=headers)
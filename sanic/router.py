@@ -1,14 +1,18 @@
 import re
-from collections import defaultdict, namedtuple
-from functools import lru_cache
+from collections import OrderedDict, namedtuple
 
 from sanic.config import Config
 from sanic.exceptions import InvalidUsage, NotFound
 
 # 路由元组
-Route = namedtuple('Route', ['handler', 'methods', 'pattern', 'parameters'])
+Route = namedtuple('Route', ['handler', 'methods', 'uri', 'parameters'])
 # 参数元组
 Parameter = namedtuple('Parameter', ['name', 'cast'])
+# 路由缓存统计
+CacheInfo = namedtuple('CacheInfo', [
+    'hits', 'misses', 'negative_hits', 'evictions', 'size', 'negative_size'])
+# 动态路径段，match 返回该段中参数的原始值元组，不匹配时返回 None
+Segment = namedtuple('Segment', ['key', 'match'])
 
 # 正则表达式，用于过滤数据类型
 REGEX_TYPES = {
@@ -19,11 +23,94 @@ REGEX_TYPES = {
 }
 
 
-def url_hash(url):
+def _match_string(segment):
+    return (segment,) if segment else None
+
+
+def _match_int(segment):
+    return (segment,) if segment.isdecimal() else None
+
+
+def _match_alpha(segment):
+    return (segment,) if segment.isascii() and segment.isalpha() else None
+
+
+# 常用数据类型的快速匹配函数，用字符串方法代替正则
+FAST_MATCHERS = {
+    'string': _match_string,
+    'int': _match_int,
+    'alpha': _match_alpha,
+}
+
+
+def _regex_matcher(pattern):
+    """
+    返回用正则表达式完整匹配路径段的函数
+    """
+    fullmatch = re.compile(pattern).fullmatch
+
+    def match(segment):
+        matched = fullmatch(segment)
+        if matched is None:
+            return None
+        return matched.groups()
+
+    return match
+
+
+def _parse_parameter(name):
+    """
+    解析参数定义 NAME or NAME:PATTERN
+    :return: (参数名, 类型名, 类型, 正则表达式)
+    """
+    type_name = 'string'
+    if ':' in name:
+        name, type_name = name.split(':', 1)
+    # 拉取先前设置的正则表达式
+    _type, pattern = REGEX_TYPES.get(type_name, (str, type_name))
+    return name, type_name, _type, pattern
+
+
+def _make_segment(segment, segment_pattern, param_count):
+    """
+    创建动态路径段，整段为单个常用类型参数时使用快速匹配函数
     """
-    辅助方法，计算 url 中`/`总数，
+    if param_count == 1 and re.fullmatch(r'<[^<>]+>', segment):
+        _, type_name, _, pattern = _parse_parameter(segment[1:-1])
+        if type_name in FAST_MATCHERS:
+            return Segment(key='<{}>'.format(type_name),
+                           match=FAST_MATCHERS[type_name])
+        pattern = '({})'.format(pattern)
+        return Segment(key=pattern, match=_regex_matcher(pattern))
+
+    return Segment(key=segment_pattern, match=_regex_matcher(segment_pattern))
+
+
+def _spans_segments(pattern):
+    """
+    判断参数的正则表达式是否可能匹配 `/`，即跨越多个路径段
+    """
+    return bool(re.search('(^|[^^]){1}/', pattern) or re.search(pattern, '/'))
+
+
+def _split_uri(uri):
+    """
+    按 `/` 拆分 URL 路径，忽略 `<...>` 参数内部的 `/`
     """
-    return url.count('/')
+    segments = []
+    depth = 0
+    start = 1
+    for index in range(1, len(uri)):
+        char = uri[index]
+        if char == '<':
+            depth += 1
+        elif char == '>':
+            depth -= 1
+        elif char == '/' and depth == 0:
+            segments.append(uri[start:index])
+            start = index + 1
+    segments.append(uri[start:])
+    return segments
 
 
 class RouteExists(Exception):
@@ -33,6 +120,32 @@ class RouteExists(Exception):
     pass
 
 
+class Node:
+    """
+    路由树节点。
+    静态路径段通过字典查找，动态路径段按注册顺序逐个检查，
+    可匹配 `/` 的参数将剩余路径作为一个整体，用正则表达式匹配。
+    """
+    __slots__ = ('static', 'dynamic', 'wildcards', 'route')
+
+    def __init__(self):
+        self.static = {}        # 静态路径段 -> 子节点
+        self.dynamic = []       # (Segment, 子节点) 列表
+        self.wildcards = []     # (剩余路径正则, Route) 列表
+        self.route = None       # 在该节点结束的路由
+
+    def dynamic_child(self, segment):
+        """
+        获取或创建动态路径段对应的子节点
+        """
+        for existing, child in self.dynamic:
+            if existing.key == segment.key:
+                return child
+        child = Node()
+        self.dynamic.append((segment, child))
+        return child
+
+
 class Router:
     """
     此路由支持附带参数和请求方式。
@@ -43,17 +156,61 @@ class Router:
     给的参数需要给定数据类型，若没有指定则默认为字符串类型。
     正则表达式同样可以作为数据类型来传递。
     赋予函数的实参始终为字符串，与数据类型无关。
+
+    路由以路径段为单位组织成树，查找的开销只与路径深度有关，与路由数量无关。
+    动态路由的匹配结果缓存在 LRU 中，每个路由最多占用 cache_route_limit 个条目，
+    避免 `/users/<id>` 这类高基数 URL 挤掉其他结果；未匹配的 URL 单独缓存。
     """
     routes_static = None            # 静态路由集合
-    routes_dynamic = None           # 动态路由集和
-    routes_always_check = None      # 检查路由列表
 
-    def __init__(self):
+    def __init__(self, cache_size=Config.ROUTER_CACHE_SIZE,
+                 negative_cache_size=Config.ROUTER_NEGATIVE_CACHE_SIZE,
+                 cache_route_limit=Config.ROUTER_CACHE_ROUTE_LIMIT):
         self.routes_all = {}        # 全部路由集合
         self.routes_static = {}     # 静态路由集合
-        self.routes_dynamic = defaultdict(list) # 动态路由集合
-        self.routes_always_check = []   # 检查路由列表
-        # self.hosts = None
+        self.tree = Node()          # 路由树
+
+        self.cache_size = cache_size                    # 匹配结果缓存大小
+        self.negative_cache_size = negative_cache_size  # 未匹配 URL 缓存大小
+        self.cache_route_limit = cache_route_limit      # 单个路由的缓存条目上限
+        self._cache = OrderedDict()             # url -> (route, kwargs)
+        self._negative_cache = OrderedDict()    # 未匹配的 url
+        self._route_cache_count = {}            # route.uri -> 缓存条目数
+        self._hits = 0
+        self._misses = 0
+        self._negative_hits = 0
+        self._evictions = 0
+
+    def configure_cache(self, cache_size=None, negative_cache_size=None,
+                        cache_route_limit=None):
+        """
+        运行时调整缓存大小，超出的条目会被淘汰
+        """
+        if cache_size is not None:
+            self.cache_size = cache_size
+        if negative_cache_size is not None:
+            self.negative_cache_size = negative_cache_size
+        if cache_route_limit is not None:
+            self.cache_route_limit = cache_route_limit
+            self.clear_cache()
+        self._shrink()
+
+    def clear_cache(self):
+        """
+        清空缓存
+        """
+        self._cache.clear()
+        self._negative_cache.clear()
+        self._route_cache_count.clear()
+
+    def cache_info(self):
+        """
+        返回缓存命中、未命中和淘汰次数
+        """
+        return CacheInfo(
+            hits=self._hits, misses=self._misses,
+            negative_hits=self._negative_hits, evictions=self._evictions,
+            size=len(self._cache), negative_size=len(self._negative_cache))
 
     def add(self, uri, methods, handler):
         """
@@ -73,48 +230,51 @@ class Router:
             methods = frozenset(methods)
 
         parameters = []
-        properties = {"unhashable": None}
 
         def add_parameter(match):
             """
             添加参数，一共两种参数: NAME or NAME:PATTERN
             """
-            name = match.group(1)
-            pattern = 'string'
-            if ':' in name:
-                name, pattern = name.split(':', 1)
-
-            default = (str, pattern)
-            # 拉取先前设置的正则表达式
-            _type, pattern = REGEX_TYPES.get(pattern, default)
-            parameter = Parameter(name=name, cast=_type)
-            parameters.append(parameter)
-
-            if re.search('(^|[^^]){1}/', pattern):
-                properties['unhashable'] = True
-            elif re.search(pattern, '/'):
-                properties['unhashable'] = True
-
+            name, type_name, _type, pattern = _parse_parameter(match.group(1))
+            parameters.append(Parameter(name=name, cast=_type))
             return '({})'.format(pattern)
 
-        pattern_string = re.sub(r'<(.+?)>', add_parameter, uri)
-        pattern = re.compile(r'^{}$'.format(pattern_string))
-
         # 设置路由
         route = Route(
-            handler=handler, methods=methods, pattern=pattern,
-            parameters=parameters
+            handler=handler, methods=methods, uri=uri, parameters=parameters
         )
 
-        # 添加路由到对应字典集合
         self.routes_all[uri] = route
-        if properties['unhashable']:
-            self.routes_always_check.append(route)
-        elif parameters:
-            self.routes_dynamic[url_hash(uri)].append(route)
-        else:
+        self.clear_cache()  # 新路由可能改变已缓存的结果
+        if '<' not in uri:
             self.routes_static[uri] = route
 
+        # 逐段插入路由树
+        node = self.tree
+        segments = _split_uri(uri)
+        for index, segment in enumerate(segments):
+            if '<' not in segment:
+                node = node.static.setdefault(segment, Node())
+                continue
+
+            if any(_spans_segments(_parse_parameter(name)[3])
+                   for name in re.findall(r'<(.+?)>', segment)):
+                # 参数可能匹配 `/`，剩余路径整体交给正则表达式匹配
+                rest = '/'.join(segments[index:])
+                rest_pattern = re.sub(r'<(.+?)>', add_parameter, rest)
+                node.wildcards.append(
+                    (re.compile(r'^{}$'.format(rest_pattern)), route))
+                break
+
+            param_count = len(parameters)
+            segment_pattern = re.sub(r'<(.+?)>', add_parameter, segment)
+            node = node.dynamic_child(_make_segment(
+                segment, segment_pattern, len(parameters) - param_count))
+        else:
+            # 同一位置已有路由时，先注册的优先
+            if node.route is None:
+                node.route = route
+
     def get(self, request):
         """
         将 URL 和处理器绑定在一起
@@ -122,37 +282,42 @@ class Router:
         :return: handler, arguments, keyword arguments
         """
 
-        return self._get(request.url, request.method,)
+        route, kwargs = self._get(request.url, request.method)
+        return route.handler, [], kwargs
+
+    def get_route(self, request):
+        """
+        获取请求对应的路由
+        :param request: request 对象
+        :return: route, keyword arguments
+        """
+        return self._get(request.url, request.method)
+
+    def get_handler(self, request):
+        """
+        获取请求对应的处理器，在读取完请求头后用于查询路由选项
+        :param request: 只含请求头的 request 对象
+        :return: 处理器，未匹配时返回 None
+        """
+        try:
+            return self.get(request)[0]
+        except (NotFound, InvalidUsage):
+            return None
 
-    @lru_cache(maxsize=Config.ROUTER_CACHE_SIZE)
     def _get(self, url, method):
         """
         get 的辅助方法
         :param url:
         :param method:
-        :return: handler, arguments, keyword arguments
+        :return: route, keyword arguments
         """
 
         # 匹配静态路由集
         route = self.routes_static.get(url)
         if route:   # 匹配成功
-            match = route.pattern.match(url)
+            kwargs = {}
         else:
-            # 匹配动态路由集
-            for route in self.routes_dynamic[url_hash(url)]:
-                match = route.pattern.match(url)
-                if match: # 匹配成功
-                    break
-            else:
-                # 匹配所有路由集合
-                for route in self.routes_always_check:
-                    match = route.pattern.match(url)
-                    if match:   # 匹配成功
-                        break
-                # 在所有集合里都没有匹配成功，抛出异常
-                else:
-                    # 此处在`exceptions.py` 中添加响应异常
-                    raise NotFound('Requested URL {} not found'.format(url))
+            route, kwargs = self._resolve(url)
 
         # 若 method 不匹配，抛出异常
         if route.methods and method not in route.methods:
@@ -160,11 +325,97 @@ class Router:
                 'Method {} not allowed for URL {}'.format(
                     method, url), status_code=405)
 
-        kwargs = {p.name: p.cast(value)
-                  for value, p
-                  in zip(match.groups(1), route.parameters)}
-        return route.handler, [], kwargs
+        return route, kwargs
 
+    def _resolve(self, url):
+        """
+        查找缓存或匹配路由树
+        :return: (route, kwargs)
+        """
+        result = self._cache.get(url)
+        if result is not None:
+            self._hits += 1
+            self._cache.move_to_end(url)
+            return result
+
+        if url in self._negative_cache:
+            self._negative_hits += 1
+            self._negative_cache.move_to_end(url)
+            raise NotFound('Requested URL {} not found'.format(url))
 
+        self._misses += 1
+        if url.startswith('/'):
+            result = self._match(self.tree, url[1:].split('/'), 0, ())
 
+        if result is None:
+            if self.negative_cache_size > 0:
+                self._negative_cache[url] = True
+                self._shrink()
+            # 此处在`exceptions.py` 中添加响应异常
+            raise NotFound('Requested URL {} not found'.format(url))
 
+        uri = result[0].uri
+        count = self._route_cache_count.get(uri, 0)
+        if self.cache_size > 0 and count < self.cache_route_limit:
+            self._route_cache_count[uri] = count + 1
+            self._cache[url] = result
+            self._shrink()
+        return result
+
+    def _shrink(self):
+        """
+        淘汰超出大小的缓存条目
+        """
+        while len(self._cache) > self.cache_size:
+            _, (route, _) = self._cache.popitem(last=False)
+            self._route_cache_count[route.uri] -= 1
+            self._evictions += 1
+        while len(self._negative_cache) > self.negative_cache_size:
+            self._negative_cache.popitem(last=False)
+            self._evictions += 1
+
+    def _match(self, node, segments, index, values):
+        """
+        在路由树中递归匹配路径段，匹配失败时回溯
+        :return: (route, kwargs) 或 None
+        """
+        if index == len(segments):
+            if node.route is not None:
+                kwargs = self._cast(node.route, values)
+                if kwargs is not None:
+                    return node.route, kwargs
+        else:
+            segment = segments[index]
+            child = node.static.get(segment)
+            if child is not None:
+                result = self._match(child, segments, index + 1, values)
+                if result is not None:
+                    return result
+            for dynamic, child in node.dynamic:
+                matched = dynamic.match(segment)
+                if matched is not None:
+                    result = self._match(
+                        child, segments, index + 1, values + matched)
+                    if result is not None:
+                        return result
+
+        if node.wildcards:
+            rest = '/'.join(segments[index:])
+            for pattern, route in node.wildcards:
+                matched = pattern.match(rest)
+                if matched:
+                    kwargs = self._cast(route, values + matched.groups())
+                    if kwargs is not None:
+                        return route, kwargs
+        return None
+
+    @staticmethod
+    def _cast(route, values):
+        """
+        按参数类型转换原始值，转换失败视为不匹配
+        """
+        try:
+            return {p.name: p.cast(value)
+                    for value, p in zip(values, route.parameters)}
+        except ValueError:
+            return None
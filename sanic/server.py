@@ -1,28 +1,230 @@
 import asyncio
+from collections import deque
 from functools import partial
+from math import ceil, inf
+from os import close, dup, pread, stat, unlink
 from signal import SIGINT, SIGTERM
+from socket import (
+    socket, AF_INET, AF_INET6, AF_UNIX, SOCK_STREAM, IPPROTO_TCP,
+    SOL_SOCKET, SO_REUSEADDR, SO_REUSEPORT, SO_KEEPALIVE, SO_SNDBUF,
+    SO_RCVBUF, TCP_NODELAY)
+from stat import S_ISSOCK
 from time import time
 
 import uvloop as async_loop # 使用 uvloop 替代 asyncio
-from multidict import CIMultiDict
+try:
+    from socket import TCP_DEFER_ACCEPT     # 仅 Linux 支持
+except ImportError:
+    TCP_DEFER_ACCEPT = None
+try:
+    from os import sendfile as os_sendfile  # 部分平台没有 sendfile
+except ImportError:
+    os_sendfile = None
 from httptools import HttpRequestParser
 from httptools.parser.errors import HttpParserError
 
+from sanic import codec
 from sanic.log import log
-from sanic.request import Request
-from sanic.exceptions import ServerError, RequestTimeout, PayloadTooLarge, InvalidUsage
+from sanic.request import Request, RequestHeaders, StreamBuffer, \
+    create_multipart_parser
+from sanic.response import ALL_STATUS_CODES, update_date
+from sanic.exceptions import (
+    ServerError, PayloadTooLarge, InvalidUsage,
+    ServiceUnavailable)
 
 
 class Signal:
-    stopped = False
+    stopped = False     # 服务器是否正在关闭
+    requests = 0        # 已接收的请求数
+    in_flight = 0       # 所有连接上正在执行的处理器数
 
 
 current_time = None
 
+# 连接所处的超时阶段
+KEEP_ALIVE, HEADER, BODY, RESPONSE = range(4)
+
+
+class TimerWheel:
+    """
+    粗粒度时间轮，由每秒一次的 update_current_time 驱动，
+    所有连接共享，代替每个连接单独的 loop.call_later。
+    连接按截止时间所在的秒数放入槽中，延长截止时间只需更新记录，
+    槽被检查时未到期的连接留在原处或移到新的槽。
+    """
+    __slots__ = ('size', 'slots', 'deadlines', 'position')
+
+    def __init__(self, size=64):
+        self.size = size
+        self.slots = [set() for _ in range(size)]   # 每秒一个槽
+        self.deadlines = {}                         # 连接 -> 截止时间
+        self.position = None                        # 上次检查到的秒数
+
+    def schedule(self, protocol, deadline):
+        """
+        设置连接的截止时间
+        """
+        old = self.deadlines.get(protocol)
+        self.deadlines[protocol] = deadline
+        index = ceil(deadline) % self.size
+        if old is None:
+            self.slots[index].add(protocol)
+        else:
+            old_index = ceil(old) % self.size
+            if old_index != index:
+                self.slots[old_index].discard(protocol)
+                self.slots[index].add(protocol)
+
+    def cancel(self, protocol):
+        """
+        移除连接
+        """
+        deadline = self.deadlines.pop(protocol, None)
+        if deadline is not None:
+            self.slots[ceil(deadline) % self.size].discard(protocol)
+
+    def tick(self, now):
+        """
+        检查从上次检查到现在经过的槽，触发到期连接的超时处理
+        """
+        second = int(now)
+        if self.position is None:
+            self.position = second - 1
+        steps = min(second - self.position, self.size)
+        self.position = second
+        for step in range(steps - 1, -1, -1):
+            slot = self.slots[(second - step) % self.size]
+            if not slot:
+                continue
+            for protocol in [p for p in slot if self.deadlines[p] <= now]:
+                self.cancel(protocol)
+                protocol.connection_timeout()
+
+
+def _build_reject_response(status, extra_headers=b''):
+    """
+    序列化不带消息体的错误响应
+    """
+    return (b'HTTP/1.1 %d %b\r\n'
+            b'%b'
+            b'Connection: close\r\n'
+            b'Content-Length: 0\r\n\r\n') % (
+        status, ALL_STATUS_CODES[status], extra_headers)
+
+
+# 预先序列化的拒绝响应，由协议直接写入，不经过错误处理器
+REJECT_RESPONSES = {
+    status: _build_reject_response(status) for status in (408, 431)}
+
+# 客户端发送 `Expect: 100-continue` 时，确认可以接收消息体后返回的临时响应
+CONTINUE_RESPONSE = b'HTTP/1.1 100 Continue\r\n\r\n'
+
+
+class LoadShedder:
+    """
+    CoDel 风格的过载判断。周期性地测量定时器的延迟执行时间，即事件循环中
+    新到达的事件需要排队多久才能被处理；一个时间窗口内的最小延迟仍然超过
+    目标值，说明队列无法自行消化，进入过载状态直到某个窗口恢复。
+    """
+    __slots__ = ('loop', 'target', 'interval', 'overloaded',
+                 '_min_delay', '_window_end', '_scheduled')
+
+    def __init__(self, loop, target=0.005, interval=0.1):
+        """
+        :param loop: 事件循环
+        :param target: 以秒为单位，可接受的排队时间
+        :param interval: 以秒为单位，时间窗口长度
+        """
+        self.loop = loop
+        self.target = target
+        self.interval = interval
+        self.overloaded = False
+        self._min_delay = inf
+        self._window_end = None
+        self._scheduled = None
+
+    def start(self):
+        """
+        开始测量
+        """
+        self._window_end = self.loop.time() + self.interval
+        self._schedule()
+
+    def _schedule(self):
+        # 每个窗口采样约十次
+        self._scheduled = self.loop.time() + self.interval / 10
+        self.loop.call_at(self._scheduled, self._measure)
+
+    def _measure(self):
+        now = self.loop.time()
+        delay = now - self._scheduled
+        if delay < self._min_delay:
+            self._min_delay = delay
+        if now >= self._window_end:
+            self.overloaded = self._min_delay > self.target
+            self._min_delay = inf
+            self._window_end = now + self.interval
+        self._schedule()
+
+
+# 常用请求方法，避免每个请求重复解码
+HTTP_METHODS = {
+    method.encode(): method for method in (
+        'GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS')
+}
+
+SENDFILE_CHUNK_SIZE = 256 * 1024    # 不支持 sendfile 时每次读取的文件块大小
+WRITELINES_THRESHOLD = 16 * 1024    # 超过该大小的响应内容不与头部拼接，避免复制
+
+
+class ResponseSlot:
+    """
+    流水线中等待响应的请求，响应按请求顺序写入。
+    响应写入后放回连接的空闲列表，供下一个请求复用。
+    """
+    __slots__ = ('protocol', 'request', 'keep_alive', 'task', 'streaming',
+                 'response', 'waiter', 'write_callback', 'stream_callback')
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.request = None             # 请求
+        self.keep_alive = False         # 请求是否要求保持连接
+        self.task = None                # 处理器 task，流式响应写入期间保留
+        self.streaming = False          # 流式响应的头部是否已开始写入
+        self.response = None            # 已生成、等待写入的响应
+        self.waiter = None              # 流式响应等待轮到自己的 future
+        # 预先绑定回调，复用时无需重新创建
+        self.write_callback = self.write_response
+        self.stream_callback = self.stream_response
+
+    def reset(self, request=None, keep_alive=False):
+        self.request = request
+        self.keep_alive = keep_alive
+        self.task = None
+        self.streaming = False
+        self.response = None
+        self.waiter = None
+
+    def write_response(self, response):
+        self.protocol.write_response(self, response)
+
+    async def stream_response(self, response):
+        await self.protocol.stream_response(self, response)
+
+
+def _set_waiter_result(waiter):
+    """
+    套接字可写时唤醒 wait_writable
+    """
+    if not waiter.done():
+        waiter.set_result(None)
+
 
 class HttpProtocol(asyncio.Protocol):
     """
-    HTTP 协议
+    HTTP 协议，支持 HTTP/1.1 流水线：
+    同一连接上的请求提前解析进有界队列，处理器按配置的并发数执行，
+    响应严格按照请求顺序写入。
     """
     # 插槽
     __slots__ = (
@@ -31,29 +233,92 @@ class HttpProtocol(asyncio.Protocol):
         # 请求参数
         'parser', 'request', 'url', 'headers',
         # 请求配置
-        'request_handler', 'request_timeout', 'request_max_size',
+        'request_handler', 'error_handler',
+        'request_max_size', 'request_buffer_queue_size',
+        'multipart_spill_size',
+        # 流式请求
+        'router', 'is_request_stream', 'route_body_limits',
+        # 流水线
+        'pipeline_size', 'pipeline_concurrency',
+        '_pipeline', '_pending', '_running', '_reading_paused', '_free_slots',
         # 连接管理
-        '_total_request_size', '_timeout_handler', '_last_communication_time')
+        '_content_length', '_content_type', '_expect_continue',
+        '_body_limit', '_body_size',
+        # 超时
+        'timer_wheel', 'keep_alive_timeout', 'request_header_timeout',
+        'request_body_timeout', 'response_timeout', '_timeout_phase',
+        # 慢速攻击防护
+        'request_max_header_size', 'request_max_headers',
+        'request_body_min_rate', 'request_body_rate_period',
+        '_header_size', '_header_bytes', '_body_window_start',
+        '_body_window_bytes',
+        # 过载保护
+        'max_connections', 'max_in_flight', 'load_shedder',
+        'overload_response', '_shedding',
+        # 写入流控
+        '_writing_paused', '_drain_waiter')
 
     def __init__(self, *, loop, request_handler, error_handler,
-                 signal=Signal(), connections={}, request_timeout=60,
-                 request_max_size=None):
+                 signal=Signal(), connections={}, timer_wheel=None,
+                 keep_alive_timeout=5, request_header_timeout=60,
+                 request_body_timeout=60, response_timeout=60,
+                 request_max_header_size=8192, request_max_headers=100,
+                 request_body_min_rate=1024, request_body_rate_period=5,
+                 max_connections=0, max_in_flight=0, load_shedder=None,
+                 overload_response=None, request_max_size=None, request_buffer_queue_size=100,
+                 multipart_spill_size=1024 * 1024,
+                 router=None, is_request_stream=False, route_body_limits=False,
+                 pipeline_size=16, pipeline_concurrency=1):
         self.loop = loop                            # 事件循环
         self.transport = None
-        self.request = None                         # 请求
-        self.parser = None
+        self.request = None                         # 正在解析的请求
+        self.parser = None                          # 在连接上复用的 parser
         self.url = None                             # 预留的路径
-        self.headers = None                         # 请求头
+        self.headers = None                         # 原始请求头列表
         self.signal = signal                        # 标志是否结束
         self.connections = connections              # 连接集合
         self.request_handler = request_handler      # 请求处理器
         self.error_handler = error_handler          # 出错处理器
-        self.request_timeout = request_timeout      # 请求超时时间
+        self.timer_wheel = timer_wheel or TimerWheel()  # 共享的时间轮
+        self.keep_alive_timeout = keep_alive_timeout    # 连接空闲超时时间
+        self.request_header_timeout = request_header_timeout  # 读取请求头超时时间
+        self.request_body_timeout = request_body_timeout  # 读取消息体超时时间
+        self.response_timeout = response_timeout    # 生成响应超时时间
+        self._timeout_phase = KEEP_ALIVE
+        self.request_max_header_size = request_max_header_size  # 请求头大小上限
+        self.request_max_headers = request_max_headers  # 请求头数量上限
+        self.request_body_min_rate = request_body_min_rate  # 消息体最低传输速率
+        self.request_body_rate_period = request_body_rate_period
+        self._header_size = 0           # 回调中已解析的请求行和请求头大小
+        self._header_bytes = 0          # 读取请求头期间收到的完整数据块大小
+        self._body_window_start = None  # 当前速率窗口的开始时间
+        self._body_window_bytes = 0     # 当前速率窗口内收到的消息体大小
+        self.max_connections = max_connections  # 每个进程的连接数上限
+        self.max_in_flight = max_in_flight      # 每个进程正在执行的处理器数上限
+        self.load_shedder = load_shedder        # 按排队时间判断过载
+        self.overload_response = overload_response or \
+            _build_reject_response(503)         # 预先序列化的 503 响应
+        self._shedding = False          # 连接数超限，收到请求后直接返回 503
         self.request_max_size = request_max_size    # 请求最大大小
-        self._total_request_size = 0
-        self._timeout_handler = None
-        self._last_request_time = None
-        self._request_handler_task = None
+        self.request_buffer_queue_size = request_buffer_queue_size
+        self.multipart_spill_size = multipart_spill_size  # 表单文件写入磁盘的阈值
+        self.router = router                        # 路由，用于判断流式处理器
+        self.is_request_stream = is_request_stream  # 是否存在流式路由
+        self.route_body_limits = route_body_limits  # 是否存在单独设置消息体上限的路由
+        self.pipeline_size = pipeline_size          # 等待响应的请求数上限
+        self.pipeline_concurrency = pipeline_concurrency  # 处理器并发数
+        self._pipeline = deque()                    # 按顺序等待响应的请求
+        self._pending = deque()                     # 尚未执行处理器的请求
+        self._running = 0                           # 正在执行的处理器数
+        self._free_slots = []                       # 可复用的 ResponseSlot
+        self._reading_paused = False
+        self._content_length = None     # 请求头中的 Content-Length
+        self._content_type = None       # 请求头中原始的 Content-Type
+        self._expect_continue = False   # 客户端是否在等待 100 Continue
+        self._body_limit = None         # 当前请求的消息体大小上限
+        self._body_size = 0             # 当前请求已收到的消息体大小
+        self._writing_paused = False
+        self._drain_waiter = None
 
     # -------------------------------------------- #
     # 连接部分
@@ -63,34 +328,92 @@ class HttpProtocol(asyncio.Protocol):
         """
         创建连接
         """
+        # 连接数超过上限时不再解析请求，等收到数据后返回 503，
+        # 避免在客户端发送请求前关闭连接导致 RST
+        if self.max_connections and \
+                len(self.connections) >= self.max_connections:
+            self._shedding = True
         self.connections.add(self)
-        self._timeout_handler = self.loop.call_later(
-            self.request_timeout, self.connection_timeout)
         self.transport = transport
-        self._last_request_time = current_time
+        self.refresh_timeout()
 
     def connection_lost(self, exc):
         """
         丢失连接
         """
         self.connections.discard(self)
-        self._timeout_handler.cancel()
+        self.timer_wheel.cancel(self)
+        self.cancel_handlers()
         self.cleanup()
 
+    def refresh_timeout(self):
+        """
+        根据连接状态重新设置超时，优先级依次为：
+        读取消息体、等待响应、读取请求头、空闲
+        """
+        if self.request is not None:
+            phase, timeout = BODY, self.request_body_timeout
+        elif self._pipeline:
+            phase, timeout = RESPONSE, self.response_timeout
+        elif self.headers is not None:
+            phase, timeout = HEADER, self.request_header_timeout
+        else:
+            phase, timeout = KEEP_ALIVE, self.keep_alive_timeout
+        self._timeout_phase = phase
+        self.timer_wheel.schedule(self, current_time + timeout)
+
     def connection_timeout(self):
         """
-        连接超时
-        """
-        time_elapsed = current_time - self._last_request_time   # 计算与上次请求间隔
-        if time_elapsed < self.request_timeout: # 未超时
-            time_left = self.request_timeout - time_elapsed
-            self._timeout_handler = \
-                self.loop.call_later(time_left, self.connection_timeout)
-        else:   # 超时
-            if self._request_handler_task:
-                self._request_handler_task.cancel()
-            exception = RequestTimeout('Request Timeout')
-            self.write_error(exception)
+        连接超时，由时间轮调用
+        """
+        phase = self._timeout_phase
+        if phase == KEEP_ALIVE:     # 空闲连接直接关闭
+            self.transport.close()
+        elif phase == RESPONSE:
+            if self._pipeline and self._pipeline[0].streaming:
+                # 流式响应的头部已经发出，无法再写入错误响应
+                self.abort()
+            else:
+                self.cancel_handlers()
+                self.write_error(ServiceUnavailable('Response Timeout'))
+        else:   # 请求头或消息体读取超时
+            self.reject(408)
+
+    def shed(self):
+        """
+        服务器过载，写入预先序列化的 503 响应并关闭连接
+        """
+        self.timer_wheel.cancel(self)
+        self.transport.write(self.overload_response)
+        self.transport.close()
+
+    def reject(self, status):
+        """
+        写入预先序列化的错误响应并中止连接，用于应对慢速或恶意客户端，
+        不经过错误处理器，也不等待写缓冲区清空
+        :param status: 408 或 431
+        """
+        self.timer_wheel.cancel(self)
+        self.cancel_handlers()
+        self.transport.write(REJECT_RESPONSES[status])
+        self.transport.abort()
+
+    def pause_writing(self):
+        """
+        写缓冲区超过高水位，暂停写入
+        """
+        self._writing_paused = True
+
+    def resume_writing(self):
+        """
+        写缓冲区回落到低水位，唤醒等待写入的流式响应
+        """
+        self._writing_paused = False
+        waiter = self._drain_waiter
+        if waiter is not None:
+            self._drain_waiter = None
+            if not waiter.done():
+                waiter.set_result(None)
 
     # -------------------------------------------- #
     # 解析部分
@@ -100,106 +423,509 @@ class HttpProtocol(asyncio.Protocol):
         """
         接受数据
         """
-        self._total_request_size += len(data)
-        if self._total_request_size > self.request_max_size:    # 请求数据过大
-            # 在`exceptions.py`中添加 PayloadTooLarge 错误
-            exception = PayloadTooLarge('Payload Too Large')
-            self.write_error(exception)
+        if self._shedding:
+            self.shed()
+            return
+
+        # 消息体传输过慢，在消费数据之前拒绝
+        if self._timeout_phase == BODY and self.request_body_min_rate \
+                and self.body_too_slow():
+            self.reject(408)
+            return
 
-        # 如果是第一次接受数据，创建 parser
+        # 如果是第一次接受数据，创建 parser，之后在连接上复用
         if self.parser is None:
-            assert self.request is None
-            self.headers = []
             self.parser = HttpRequestParser(self)
 
         # 解析请求
+        headers = self.headers
         try:
             self.parser.feed_data(data)
         except HttpParserError:
+            if self.transport.is_closing():     # 已在回调中拒绝，停止读取
+                return
             exception = InvalidUsage('Bad Request')
             self.write_error(exception)
+            return
+
+        # 整个数据块都属于同一个请求的请求头，httptools 会在内部缓存未完成的
+        # 请求头，单靠回调无法限制逐字节发送的超长请求头。数据块中开始了新的
+        # 请求时 on_message_begin 会创建新的列表，前面的字节属于已完成的请求
+        if headers is not None and self.headers is headers:
+            self._header_bytes += len(data)
+            if self._header_bytes > self.request_max_header_size:
+                self.reject(431)
+
+    def body_too_slow(self):
+        """
+        检查消息体传输速率，每个时间窗口结束时计算一次
+        :return: True 为低于最低速率
+        """
+        elapsed = current_time - self._body_window_start
+        if elapsed < self.request_body_rate_period:
+            return False
+        stream = self.request.stream
+        if stream is None or not stream.pending:
+            # 处理器积压数据时速率由处理器决定，不做检查
+            if self._body_window_bytes < \
+                    self.request_body_min_rate * elapsed:
+                return True
+        self._body_window_start = current_time
+        self._body_window_bytes = 0
+        return False
+
+    def on_message_begin(self):
+        """
+        开始解析新的请求，请求头列表交给 Request 持有，每个请求单独创建
+        """
+        self.headers = []
+        self.url = None
+        self._header_size = 0
+        self._header_bytes = 0
+        self._content_length = None
+        self._content_type = None
+        self._expect_continue = False
+
+        # 过载时在创建 Request 和查询路由之前拒绝。
+        # 流水线中有未完成的响应时无法插入 503，交给正常流程处理
+        if not self._pipeline and (
+                self.max_in_flight and
+                self.signal.in_flight >= self.max_in_flight or
+                self.load_shedder is not None and
+                self.load_shedder.overloaded):
+            self.shed()
+            raise HttpParserError('Server overloaded')
+        self.refresh_timeout()
 
     def on_url(self, url):
         """
-        获得 url
+        获得 url，url 跨越多个数据块时会被分段回调
         """
-        self.url = url
+        self._header_size += len(url)
+        if self._header_size > self.request_max_header_size:
+            self.reject(431)
+            raise HttpParserError('Request header fields too large')
+
+        if self.url is None:
+            self.url = url
+        else:
+            self.url += url
 
     def on_header(self, name, value):
         """
         补全 HTTP 请求的 head 信息
         """
-        if name == b'Content-Length' and int(value) > self.request_max_size:
-            exception = PayloadTooLarge('Payload Too Large')
-            self.write_error(exception)
+        self._header_size += len(name) + len(value) + 4
+        if self._header_size > self.request_max_header_size or \
+                len(self.headers) >= self.request_max_headers:
+            self.reject(431)
+            raise HttpParserError('Request header fields too large')
 
-        self.headers.append((name.decode(), value.decode('utf-8')))
+        # 消息体大小上限取决于路由，在请求头读取完毕后检查
+        if len(name) == 14 and name.lower() == b'content-length':
+            self._content_length = int(value)
+        elif len(name) == 6 and name.lower() == b'expect':
+            self._expect_continue = value.lower() == b'100-continue'
+        elif len(name) == 12 and name.lower() == b'content-type':
+            self._content_type = value
+
+        # 保留原始 bytes，由 RequestHeaders 在访问时解码
+        self.headers.append((name, value))
 
     def on_headers_complete(self):
         """
         写入 HTTP 请求 head 信息
         """
-        # 远程地址
-        remote_addr = self.transport.get_extra_info('peername')
-        if remote_addr:
-            self.headers.append(('Remote-Addr', '%s:%s' % remote_addr))
+        method = self.parser.get_method()
 
         # HTTP 请求 head
         self.request = Request(
             url_bytes=self.url,
-            headers=CIMultiDict(self.headers),
+            headers=RequestHeaders(self.headers),
             version=self.parser.get_http_version(),
-            method=self.parser.get_method().decode()
+            method=HTTP_METHODS.get(method) or method.decode(),
+            transport=self.transport
         )
+        self.headers = None
+        self._body_window_start = current_time
+        self._body_window_bytes = 0
+
+        # 查询路由选项：流式处理器和消息体大小上限
+        handler = None
+        if self.is_request_stream or self.route_body_limits:
+            handler = self.router.get_handler(self.request)
+        limit = getattr(handler, 'max_body_size', None)
+        if limit is None:
+            limit = self.request_max_size
+        self._body_limit = limit
+        self._body_size = 0
+
+        # 在读取消息体之前拒绝过大的请求
+        if limit is not None and self._content_length is not None \
+                and self._content_length > limit:
+            self.payload_too_large()
+            raise HttpParserError('Payload too large')
+        if self._expect_continue and self.request.version == '1.1':
+            self.transport.write(CONTINUE_RESPONSE)
+
+        # 流式路由在读取完请求头后立即执行处理器，消息体从 stream 读取
+        if getattr(handler, 'is_stream', False):
+            self.request.body = b''
+            self.request.stream = StreamBuffer(
+                self.loop, self.transport, self.request_buffer_queue_size)
+            slot = self.enqueue_request(self.request)
+            # 流式处理器需要消费消息体，不受并发数限制
+            self.execute_request_handler(slot)
+        elif self._content_type is not None:
+            # multipart 表单在接收消息体时增量解析，不保留完整消息体
+            self.request.multipart = create_multipart_parser(
+                self._content_type, self.multipart_spill_size)
+        self.refresh_timeout()
+
+    def payload_too_large(self):
+        """
+        消息体超过上限，写入 413 响应并关闭连接，不再读取剩余数据
+        """
+        self.cancel_handlers()
+        exception = PayloadTooLarge('Payload Too Large')
+        self.write_error(exception)
 
     def on_body(self, body):
         """
         写入 HTTP 请求 body
         """
-        if self.request.body:
-            self.request.body += body
+        if self._timeout_phase == BODY:     # 收到数据，延长超时时间
+            self.timer_wheel.schedule(
+                self, current_time + self.request_body_timeout)
+        self._body_window_bytes += len(body)
+        self._body_size += len(body)
+        if self._body_limit is not None and \
+                self._body_size > self._body_limit:     # 分块传输的消息体过大
+            self.payload_too_large()
+            raise HttpParserError('Payload too large')
+        if self.request.stream is not None:
+            self.request.stream.put(body)
+        elif self.request.multipart is not None:
+            self.request.multipart.feed(body)
         else:
-            self.request.body = body
+            self.request.body_push(body)
 
     def on_message_complete(self):
+        """
+        请求接收完毕
+        """
+        request = self.request
+        self.request = None
+        self.url = None
+
+        if request.stream is not None:
+            request.stream.feed_eof()
+        else:
+            if request.multipart is not None:
+                request.multipart.feed_eof()
+            request.body_finish()
+            slot = self.enqueue_request(request)
+            if self._running < self.pipeline_concurrency:
+                self.execute_request_handler(slot)
+            else:
+                self._pending.append(slot)
+        self.refresh_timeout()
+
+    def enqueue_request(self, request):
+        """
+        将请求加入流水线，流水线已满时暂停读取
+        """
+        slot = self._free_slots.pop() if self._free_slots \
+            else ResponseSlot(self)
+        slot.reset(request, self.parser.should_keep_alive())
+        self._pipeline.append(slot)
+        self.signal.requests += 1
+        if len(self._pipeline) >= self.pipeline_size and \
+                not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+        return slot
+
+    def execute_request_handler(self, slot):
         """
         创建 task
         """
-        self._request_handler_task = self.loop.create_task(
-            self.request_handler(self.request, self.write_response))
+        self._running += 1
+        self.signal.in_flight += 1
+        slot.task = self.loop.create_task(
+            self.request_handler(
+                slot.request, slot.write_callback, slot.stream_callback))
+
+    def cancel_handlers(self):
+        """
+        取消流水线中所有的处理器
+        """
+        for slot in self._pipeline:
+            if slot.task is not None:
+                slot.task.cancel()
+            if slot.waiter is not None and not slot.waiter.done():
+                slot.waiter.cancel()
+        self._pipeline.clear()
+        self._pending.clear()
+        self.signal.in_flight -= self._running
+        self._running = 0
+        # 唤醒等待写缓冲区回落的流式响应
+        waiter = self._drain_waiter
+        if waiter is not None:
+            self._drain_waiter = None
+            if not waiter.done():
+                waiter.cancel()
 
     # -------------------------------------------- #
     # 响应部分
     # -------------------------------------------- #
 
-    def write_response(self, response):
+    def keep_alive(self, slot):
+        """
+        判断响应后是否保持连接
+        """
+        if not slot.keep_alive or self.signal.stopped:
+            return False
+        # 流式请求的消息体未读完时无法复用连接
+        stream = slot.request.stream
+        return stream is None or stream.at_eof
+
+    def write_response(self, slot, response):
+        """
+        编写 HTTP 响应，前面的请求尚未响应时先缓存
+        """
+        self._running -= 1
+        self.signal.in_flight -= 1
+        slot.task = None
+        slot.response = response
+        self.flush_pipeline()
+
+    def flush_pipeline(self):
         """
-        编写 HTTP 响应
+        按请求顺序写入已生成的响应
         """
+        pipeline = self._pipeline
+        while pipeline:
+            slot = pipeline[0]
+            if slot.response is None:
+                # 轮到流式响应写入
+                if slot.waiter is not None and not slot.waiter.done():
+                    slot.waiter.set_result(None)
+                break
+            pipeline.popleft()
+            try:
+                keep_alive = self.keep_alive(slot)
+                response = slot.response
+                version = slot.request.version
+                # 输出响应，HEAD 只写入头部，Content-Length 仍为消息体长度；
+                # 较大的响应内容与头部分开写入，避免复制
+                if slot.request.method == 'HEAD':
+                    self.transport.write(response.get_headers(
+                        version, keep_alive, self.keep_alive_timeout))
+                elif len(response.body) > WRITELINES_THRESHOLD:
+                    self.transport.writelines((
+                        response.get_headers(
+                            version, keep_alive, self.keep_alive_timeout),
+                        response.body))
+                else:
+                    self.transport.write(response.output(
+                        version, keep_alive, self.keep_alive_timeout))
+            except Exception as e:
+                self.bail_out(
+                    "Writing response failed, connection closed {}".format(e))
+                return
+            if not self.response_written(slot, keep_alive):
+                return
+            self.release_slot(slot)
+
+        self.refresh_timeout()
+        self.next_request()
+
+    async def stream_response(self, slot, response):
+        """
+        分块写入流式 HTTP 响应或文件响应
+        """
+        # 保留 slot.task，连接断开、超时或关闭服务器时仍可取消写入
+        self._running -= 1
+        self.signal.in_flight -= 1
+        if self._pipeline and self._pipeline[0] is not slot:
+            # 等待前面的响应写入完毕
+            slot.waiter = self.loop.create_future()
+            await slot.waiter
+            slot.waiter = None
+
         try:
-            keep_alive = self.parser.should_keep_alive() \
-                            and not self.signal.stopped
-            # 输出响应
-            self.transport.write(
-                response.output(
-                    self.request.version, keep_alive, self.request_timeout))
-            if not keep_alive:
-                self.transport.close()
-            else:
-                # 记录接收到的数据
-                self._last_request_time = current_time
-                self.cleanup()
+            keep_alive = self.keep_alive(slot)
+            response.protocol = self
+            slot.streaming = True
+            keep_alive = await response.stream(
+                slot.request, keep_alive, self.keep_alive_timeout)
         except Exception as e:
-            self.bail_out(
-                "Writing response failed, connection closed {}".format(e))
+            # 头部可能已经发出，无法再写入错误响应，直接关闭连接
+            log.error(
+                "Streaming response failed, connection closed {}".format(e))
+            self.transport.close()
+            return
+
+        if self._pipeline and self._pipeline[0] is slot:
+            self._pipeline.popleft()
+        if self.response_written(slot, keep_alive):
+            self.release_slot(slot)
+            self.flush_pipeline()
+
+    def response_written(self, slot, keep_alive):
+        """
+        响应写入完毕，关闭连接或继续处理下一个请求
+        :return: True 为保持连接
+        """
+        if not keep_alive:
+            self.cancel_handlers()
+            self.transport.close()
+            return False
+
+        if slot.request.stream is not None:
+            slot.request.stream.resume()
+        return True
+
+    def release_slot(self, slot):
+        """
+        放回已写入响应的 ResponseSlot
+        """
+        slot.reset()
+        if len(self._free_slots) < self.pipeline_size:
+            self._free_slots.append(slot)
+
+    def next_request(self):
+        """
+        执行等待中的处理器，流水线有空位时恢复读取
+        """
+        while self._pending and self._running < self.pipeline_concurrency:
+            self.execute_request_handler(self._pending.popleft())
+        if self._reading_paused and len(self._pipeline) < self.pipeline_size:
+            self._reading_paused = False
+            # 暂停读取期间不计入消息体传输速率
+            self._body_window_start = current_time
+            self._body_window_bytes = 0
+            self.transport.resume_reading()
+
+    def push_data(self, data):
+        """
+        写入数据，供流式响应调用
+        """
+        if self._timeout_phase == RESPONSE:     # 响应仍在输出，延长超时时间
+            self.timer_wheel.schedule(
+                self, current_time + self.response_timeout)
+        self.transport.write(data)
+
+    async def sendfile(self, file, offset, count):
+        """
+        将文件内容写入 transport，优先使用 loop.sendfile 零拷贝传输；
+        事件循环不支持时（如 uvloop）直接对套接字调用 os.sendfile；
+        都不可用时在线程池中分块读取
+        """
+        try:
+            await self.loop.sendfile(
+                self.transport, file, offset, count, fallback=False)
+            return
+        except (NotImplementedError, asyncio.SendfileNotAvailableError):
+            pass
+
+        sock = self.transport.get_extra_info('socket')
+        if os_sendfile is not None and sock is not None and \
+                self.transport.get_extra_info('sslcontext') is None:
+            await self.sendfile_native(sock.fileno(), file, offset, count)
+            return
+
+        fd = file.fileno()
+        while count > 0:
+            data = await self.loop.run_in_executor(
+                None, pread, fd, min(SENDFILE_CHUNK_SIZE, count), offset)
+            if not data:
+                raise ServerError('File truncated while sending')
+            self.push_data(data)
+            offset += len(data)
+            count -= len(data)
+            await self.drain()
+
+    async def sendfile_native(self, sock_fd, file, offset, count):
+        """
+        使用 os.sendfile 由内核直接将文件写入套接字。
+        先等待 transport 的写缓冲区清空，保证头部在文件内容之前发出；
+        套接字写满时在复制出的描述符上等待可写，
+        transport 占用的描述符不能再注册到事件循环
+        """
+        await self.flush()
+        out_fd = dup(sock_fd)
+        in_fd = file.fileno()
+        try:
+            while count > 0:
+                if self.transport.is_closing():
+                    raise ConnectionResetError('Connection lost')
+                try:
+                    sent = os_sendfile(out_fd, in_fd, offset, count)
+                except BlockingIOError:
+                    await self.wait_writable(out_fd)
+                    continue
+                if not sent:
+                    raise ServerError('File truncated while sending')
+                offset += sent
+                count -= sent
+                if self._timeout_phase == RESPONSE:     # 延长超时时间
+                    self.timer_wheel.schedule(
+                        self, current_time + self.response_timeout)
+        finally:
+            close(out_fd)
+
+    async def wait_writable(self, fd):
+        """
+        等待描述符可写
+        """
+        waiter = self.loop.create_future()
+        self.loop.add_writer(fd, _set_waiter_result, waiter)
+        try:
+            await waiter
+        finally:
+            self.loop.remove_writer(fd)
+
+    async def flush(self):
+        """
+        等待 transport 的写缓冲区完全清空
+        """
+        transport = self.transport
+        if not transport.get_write_buffer_size():
+            return
+        low, high = transport.get_write_buffer_limits()
+        # 高水位设为 0，缓冲区清空后才会调用 resume_writing
+        transport.set_write_buffer_limits(high=0, low=0)
+        try:
+            while transport.get_write_buffer_size():
+                if self._writing_paused:
+                    await self.drain()
+                else:
+                    await asyncio.sleep(0)
+        finally:
+            transport.set_write_buffer_limits(high=high, low=low)
+
+    async def drain(self):
+        """
+        写缓冲区超过高水位时，等待其回落
+        """
+        if self.transport.is_closing():
+            raise ConnectionResetError('Connection lost')
+        if self._writing_paused:
+            self._drain_waiter = self.loop.create_future()
+            await self._drain_waiter
 
     def write_error(self, exception):
         """
         编写 HTTP 错误响应
         """
         try:
-            response = self.error_handler.response(self.request, exception)
-            version = self.request.version if self.request else '1.1'
+            request = self.request
+            if request is None and self._pipeline:
+                request = self._pipeline[0].request
+            response = self.error_handler.response(request, exception)
+            version = request.version if request is not None else '1.1'
             self.transport.write(response.output(version))
             self.transport.close()
         except Exception as e:
@@ -222,36 +948,129 @@ class HttpProtocol(asyncio.Protocol):
         self.request = None
         self.url = None
         self.headers = None
-        self._request_handler_task = None
-        self._total_request_size = 0
+        self._free_slots.clear()
+
+    @property
+    def in_flight(self):
+        """
+        已开始接收但尚未响应完毕的请求数
+        """
+        count = len(self._pipeline)
+        # 流式请求在读取请求头后就已进入流水线
+        if self.request is not None and self.request.stream is None:
+            count += 1
+        return count
+
+    def abort(self):
+        """
+        取消所有处理器并立即中止连接，用于关闭服务器超时
+        """
+        self.cancel_handlers()
+        self.transport.abort()
 
     def close_if_idle(self):
         """
         若没有发生或接受请求，则关闭连接
         :return: boolean - True 为关, false 为保持开启
         """
-        if not self.parser:
+        if not self._pipeline and self.request is None and self.url is None:
             self.transport.close()
             return True
         return False
 
 
-def update_current_time(loop):
+def update_current_time(loop, timer_wheel=None):
     """
     更新当前时间，当前时间是一个全局变量
     因为在每个 keep-alive 请求结束后需要更新请求超时时间
+    同时驱动时间轮检查超时连接
     """
     global current_time
     current_time = time()
-    loop.call_later(1, partial(update_current_time, loop))
+    update_date(current_time)
+    if timer_wheel is not None:
+        timer_wheel.tick(current_time)
+    loop.call_later(1, partial(update_current_time, loop, timer_wheel))
+
+
 
 
 
+def bind_socket(host=None, port=None, uds=None, reuse_port=False,
+                backlog=100, tcp_nodelay=True, tcp_defer_accept=0,
+                keepalive=False, send_buffer=None, receive_buffer=None):
+    """
+    创建并配置监听套接字，已接受的连接会继承这些选项
+    :param host: 服务器地址
+    :param port: 服务器端口
+    :param uds: Unix 域套接字路径，指定后忽略 host 和 port
+    :param reuse_port: 设置 SO_REUSEPORT，由内核在多个套接字间分配连接
+    :param backlog: 等待 accept 的连接数上限
+    :param tcp_nodelay: 关闭 Nagle 算法
+    :param tcp_defer_accept: 以秒为单位，客户端发送数据后才唤醒 accept
+    :param keepalive: 开启 TCP keepalive 探测
+    :param send_buffer: 发送缓冲区大小，`None` 使用系统默认值
+    :param receive_buffer: 接收缓冲区大小，`None` 使用系统默认值
+    :return: 已开始监听的套接字
+    """
+    if uds is not None:
+        sock = socket(AF_UNIX, SOCK_STREAM)
+        try:    # 清除上次运行遗留的套接字文件
+            if S_ISSOCK(stat(uds).st_mode):
+                unlink(uds)
+        except FileNotFoundError:
+            pass
+        sock.bind(uds)
+    else:
+        sock = socket(AF_INET6 if ':' in host else AF_INET, SOCK_STREAM)
+        sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        if tcp_nodelay:
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        if tcp_defer_accept and TCP_DEFER_ACCEPT is not None:
+            sock.setsockopt(IPPROTO_TCP, TCP_DEFER_ACCEPT, tcp_defer_accept)
+        if keepalive:
+            sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+        sock.bind((host, port))
+
+    if send_buffer:
+        sock.setsockopt(SOL_SOCKET, SO_SNDBUF, send_buffer)
+    if receive_buffer:
+        sock.setsockopt(SOL_SOCKET, SO_RCVBUF, receive_buffer)
+    sock.listen(backlog)
+    return sock
+
+
+def check_max_requests(loop, signal, max_requests):
+    """
+    每秒检查一次进程处理的请求数，达到上限后关闭服务器，
+    由 supervisor 启动新的进程代替
+    """
+    if signal.requests >= max_requests:
+        log.info("Worker reached {} requests, recycling".format(
+            signal.requests))
+        loop.stop()
+        return
+    loop.call_later(
+        1, partial(check_max_requests, loop, signal, max_requests))
 
 
 def serve(host, port, request_handler, error_handler, debug=False,
-          request_timeout=60, sock=None, request_max_size=None,
-          reuse_port=False, loop=None, protocol=HttpProtocol, backlog=100):
+          keep_alive_timeout=5, request_header_timeout=60,
+          request_body_timeout=60, response_timeout=60,
+          request_max_header_size=8192, request_max_headers=100,
+          request_body_min_rate=1024, request_body_rate_period=5,
+          sock=None, request_max_size=None,
+          reuse_port=False, loop=None, protocol=HttpProtocol, backlog=100,
+          request_buffer_queue_size=100, multipart_spill_size=1024 * 1024,
+          router=None,
+          is_request_stream=False, route_body_limits=False,
+          pipeline_size=16, pipeline_concurrency=1,
+          graceful_shutdown_timeout=15, max_requests=0, ready_event=None,
+          drain_event=None, uds=None, socket_options=None, max_connections=0, max_in_flight=0,
+          shed_target=0, shed_interval=0.1, retry_after=1,
+          json_codec='ujson', json_offload_threshold=0):
     """
     在一个独立进程中启动异步 HTTP 服务器.
     :param host: 服务器地址
@@ -259,13 +1078,45 @@ def serve(host, port, request_handler, error_handler, debug=False,
     :param request_handler: 请求处理器
     :param error_handler: 异常处理器
     :param debug: 开启 debug 输出
-    :param request_timeout: 以秒为单位，请求超时时间
+    :param keep_alive_timeout: 以秒为单位，连接空闲超时时间
+    :param request_header_timeout: 以秒为单位，读取请求头超时时间
+    :param request_body_timeout: 以秒为单位，两次收到消息体数据之间的超时时间
+    :param response_timeout: 以秒为单位，生成响应超时时间
+    :param request_max_header_size: 请求行和请求头的总大小上限
+    :param request_max_headers: 请求头数量上限
+    :param request_body_min_rate: 消息体最低传输速率，字节/秒，0 为不限制
+    :param request_body_rate_period: 以秒为单位，计算传输速率的时间窗口
     :param sock: 接受连接的套接字
     :param request_max_size: 大小以字节为单位，`None`代表无限制
     :param reuse_port: `True` for multiple workers
     :param loop: 异步事件循环
     :param protocol: 异步协议类的子类
+    :param request_buffer_queue_size: 流式请求缓存的数据块上限
+    :param multipart_spill_size: 表单文件超过此大小后写入磁盘临时文件
+    :param router: 路由，用于判断流式处理器
+    :param is_request_stream: 是否存在流式路由
+    :param route_body_limits: 是否存在单独设置消息体大小上限的路由
+    :param pipeline_size: 每个连接上等待响应的请求数上限
+    :param pipeline_concurrency: 每个连接上同时执行的处理器数
+    :param graceful_shutdown_timeout: 以秒为单位，关闭时等待请求处理完毕的
+                                      最长时间，超时后中止剩余连接
+    :param max_requests: 处理的请求数达到上限后退出，0 为不限制
+    :param ready_event: 服务器开始监听后设置的事件，供 supervisor 使用
+    :param drain_event: 服务器开始排空连接时设置的事件，供 supervisor 使用
+    :param uds: 监听的 Unix 域套接字路径
+    :param socket_options: 创建监听套接字时传给 `bind_socket` 的选项
+    :param max_connections: 连接数上限，超过后返回 503，0 为不限制
+    :param max_in_flight: 正在执行的处理器数上限，超过后返回 503，0 为不限制
+    :param shed_target: 以秒为单位，按排队时间判断过载的目标值，0 为关闭
+    :param shed_interval: 以秒为单位，判断过载的时间窗口
+    :param retry_after: 以秒为单位，503 响应中的 `Retry-After`
+    :param json_codec: JSON 编解码器名称
+    :param json_offload_threshold: 以字节为单位，超过此大小的 JSON 在线程池中
+                                   解码，0 为不使用线程池
     """
+    # 工作进程可能以 spawn 方式启动，在这里选择编解码器
+    codec.use_codec(json_codec, json_offload_threshold)
+
     # 创建事件循环
     loop = loop or async_loop.new_event_loop()
     asyncio.set_event_loop(loop)
@@ -278,6 +1129,13 @@ def serve(host, port, request_handler, error_handler, debug=False,
 
     connections = set()
     signal = Signal()
+    timer_wheel = TimerWheel()
+    load_shedder = None
+    if shed_target:
+        load_shedder = LoadShedder(loop, shed_target, shed_interval)
+        loop.call_soon(load_shedder.start)
+    overload_response = _build_reject_response(
+        503, b'Retry-After: %d\r\n' % retry_after)
     # 配置 server 参数
     server = partial(
         protocol,
@@ -286,24 +1144,46 @@ def serve(host, port, request_handler, error_handler, debug=False,
         signal=signal,
         request_handler=request_handler,
         error_handler=error_handler,
-        request_timeout=request_timeout,
+        timer_wheel=timer_wheel,
+        keep_alive_timeout=keep_alive_timeout,
+        request_header_timeout=request_header_timeout,
+        request_body_timeout=request_body_timeout,
+        response_timeout=response_timeout,
+        request_max_header_size=request_max_header_size,
+        request_max_headers=request_max_headers,
+        request_body_min_rate=request_body_min_rate,
+        request_body_rate_period=request_body_rate_period,
+        max_connections=max_connections,
+        max_in_flight=max_in_flight,
+        load_shedder=load_shedder,
+        overload_response=overload_response,
         request_max_size=request_max_size,
-    )
-
-    # 创建 server 协程
-    server_coroutine = loop.create_server(
-        server,
-        host,
-        port,
-        reuse_port=reuse_port,
-        sock=sock,
-        backlog=backlog
+        request_buffer_queue_size=request_buffer_queue_size,
+        multipart_spill_size=multipart_spill_size,
+        router=router,
+        is_request_stream=is_request_stream,
+        route_body_limits=route_body_limits,
+        pipeline_size=pipeline_size,
+        pipeline_concurrency=pipeline_concurrency,
     )
 
     # 每分钟都 pull time，而不是在每个请求结束后
-    loop.call_soon(partial(update_current_time, loop))
+    loop.call_soon(partial(update_current_time, loop, timer_wheel))
 
     try:
+        # 未传入套接字时自行创建，多进程下每个进程各自绑定 SO_REUSEPORT 套接字
+        own_uds = sock is None and uds is not None
+        if sock is None:
+            sock = bind_socket(host, port, uds=uds, reuse_port=reuse_port,
+                               backlog=backlog, **(socket_options or {}))
+
+        # 创建 server 协程
+        if sock.family == AF_UNIX:
+            server_coroutine = loop.create_unix_server(
+                server, sock=sock, backlog=backlog)
+        else:
+            server_coroutine = loop.create_server(
+                server, sock=sock, backlog=backlog)
         http_server = loop.run_until_complete(server_coroutine)     # 启动协程
     except Exception:
         log.exception("Unable to start server")
@@ -315,26 +1195,51 @@ def serve(host, port, request_handler, error_handler, debug=False,
     for _signal in (SIGINT, SIGTERM):
         loop.add_signal_handler(_signal, loop.stop)
 
+    if max_requests:
+        loop.call_later(
+            1, partial(check_max_requests, loop, signal, max_requests))
+    if ready_event is not None:
+        ready_event.set()
+
     # 启动服务器
     try:
         loop.run_forever()
     finally:
         log.info("Stop requested, draining connections...")
 
+        # 排空期间忽略重复的信号，否则 loop.stop 会中断 run_until_complete
+        for _signal in (SIGINT, SIGTERM):
+            loop.add_signal_handler(_signal, lambda: None)
+        if drain_event is not None:
+            drain_event.set()
 
-
-        # 事件循环解说后释放所有连接
+        # 停止接受新连接
         http_server.close()
-        loop.run_until_complete(http_server.wait_closed())
 
-        # 再循环中完成所有 tasks
+        # 关闭空闲连接，之后的响应都带有 `Connection: close`
         signal.stopped = True
-        for connection in connections:
-            connection.close_if_idle()
+        in_flight = 0
+        for connection in list(connections):
+            if not connection.close_if_idle():
+                in_flight += connection.in_flight
 
-        while connections:
+        # 等待处理中的请求完成，超过期限后强制中止
+        deadline = time() + graceful_shutdown_timeout
+        while connections and time() < deadline:
             loop.run_until_complete(asyncio.sleep(0.1))
 
+        aborted = 0
+        for connection in list(connections):
+            aborted += connection.in_flight
+            connection.abort()
+        if aborted or connections:
+            # 让被取消的处理器和 connection_lost 回调执行完毕
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.run_until_complete(asyncio.sleep(0))
+        loop.run_until_complete(http_server.wait_closed())
 
-
+        log.info("Drained {} requests, aborted {} requests".format(
+            max(in_flight - aborted, 0), aborted))
+        if own_uds:
+            unlink(uds)
         loop.close()
@@ -0,0 +1,192 @@
+from collections import OrderedDict, namedtuple
+from email.utils import formatdate
+from mimetypes import guess_type
+from os import path, stat
+from stat import S_ISREG
+from time import time
+from urllib.parse import unquote
+
+from sanic.exceptions import NotFound, InvalidUsage
+from sanic.response import HTTPResponse, FileHTTPResponse
+
+# 文件元数据
+FileInfo = namedtuple('FileInfo', [
+    'size', 'mtime', 'content_type', 'etag', 'last_modified', 'body', 'file',
+    'checked_at'])
+
+# 不存在的文件
+MISSING = FileInfo(size=None, mtime=None, content_type=None, etag=None,
+                   last_modified=None, body=None, file=None, checked_at=None)
+
+# 预压缩文件后缀，按优先级排列
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+REVALIDATE_INTERVAL = 1     # 两次检查文件 mtime 的最小间隔，单位秒
+
+
+class StaticFileCache:
+    """
+    静态文件缓存，LRU 淘汰。
+    缓存文件大小、修改时间、媒体类型和 ETag，小文件内容直接缓存在内存中，
+    大文件保持打开的文件对象供 sendfile 复用；mtime 变化时重新加载。
+    不存在的文件同样会被缓存，避免重复 stat。
+    """
+
+    def __init__(self, max_entries=1024, max_memory_file_size=64 * 1024,
+                 max_open_files=128):
+        self.max_entries = max_entries                      # 最大缓存条目数
+        self.max_memory_file_size = max_memory_file_size    # 缓存内容的文件大小上限
+        self.max_open_files = max_open_files                # 保持打开的文件数上限
+        self._entries = OrderedDict()
+        self._open_files = 0
+
+    def get(self, file_path):
+        """
+        获取文件元数据，文件不存在时返回 None
+        """
+        now = time()
+        info = self._entries.get(file_path)
+        if info is not None:
+            if now - info.checked_at >= REVALIDATE_INTERVAL:
+                info = self._revalidate(file_path, info, now)
+            else:
+                self._entries.move_to_end(file_path)
+        else:
+            info = self._load(file_path, now)
+            self._entries[file_path] = info
+            if len(self._entries) > self.max_entries:
+                self._evict(next(iter(self._entries)))
+
+        if info.size is None:
+            return None
+        return info
+
+    def _revalidate(self, file_path, info, now):
+        """
+        检查文件 mtime 和大小，发生变化时重新加载
+        """
+        try:
+            stats = stat(file_path)
+        except OSError:
+            stats = None
+
+        if stats is None and info.size is None or \
+                stats is not None and stats.st_mtime_ns == info.mtime \
+                and stats.st_size == info.size:
+            info = info._replace(checked_at=now)
+        else:
+            self._evict(file_path)
+            info = self._load(file_path, now)
+        self._entries[file_path] = info
+        self._entries.move_to_end(file_path)
+        return info
+
+    def _load(self, file_path, now):
+        """
+        读取文件元数据，文件不存在时返回 size 为 None 的条目
+        """
+        try:
+            stats = stat(file_path)
+        except OSError:
+            stats = None
+        if stats is None or not S_ISREG(stats.st_mode):
+            return MISSING._replace(checked_at=now)
+
+        content_type = guess_type(file_path)[0] or 'text/plain'
+        etag = 'W/"%x-%x"' % (stats.st_size, stats.st_mtime_ns)
+        last_modified = formatdate(stats.st_mtime, usegmt=True)
+        body = _file = None
+        if stats.st_size <= self.max_memory_file_size:
+            with open(file_path, 'rb') as f:
+                body = f.read()
+        elif self._open_files < self.max_open_files:
+            # 文件对象在被淘汰后由引用计数回收，不影响正在发送的响应
+            _file = open(file_path, 'rb')
+            self._open_files += 1
+
+        return FileInfo(size=stats.st_size, mtime=stats.st_mtime_ns,
+                        content_type=content_type, etag=etag,
+                        last_modified=last_modified,
+                        body=body, file=_file, checked_at=now)
+
+    def _evict(self, file_path):
+        """
+        移除缓存条目
+        """
+        info = self._entries.pop(file_path, None)
+        if info is not None and info.file is not None:
+            self._open_files -= 1
+
+
+def parse_accept_encoding(header):
+    """
+    解析 `Accept-Encoding` 头部，返回可接受的编码集合（忽略 q=0）
+    """
+    accepted = set()
+    for item in header.split(','):
+        encoding, _, params = item.partition(';')
+        params = params.replace(' ', '')
+        if params in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(encoding.strip().lower())
+    return accepted
+
+
+def register(app, uri, file_or_directory, pattern, cache):
+    """
+    注册静态文件路由
+    :param app: Sanic 对象
+    :param uri: URL 路径
+    :param file_or_directory: 静态文件或目录路径
+    :param pattern: 匹配文件路径的正则表达式
+    :param cache: StaticFileCache 对象
+    """
+    root = path.abspath(file_or_directory)
+    is_file = path.isfile(root)
+
+    async def _handler(request, file_uri=None):
+        if is_file:
+            file_path = root
+        else:
+            # 去掉开头的 `/`，防止访问根目录以外的文件
+            file_uri = unquote(file_uri or '').lstrip('/')
+            file_path = path.abspath(path.join(root, file_uri))
+            if not file_path.startswith(root + path.sep):
+                raise InvalidUsage('Invalid URL', status_code=403)
+
+        info = cache.get(file_path)
+        if info is None:
+            raise NotFound('File not found')
+
+        # 可能返回预压缩文件，无论请求是否带 Accept-Encoding 都要告知缓存
+        headers = {'ETag': info.etag, 'Last-Modified': info.last_modified,
+                   'Vary': 'Accept-Encoding'}
+        accept_encoding = request.headers.get('Accept-Encoding')
+        if accept_encoding:
+            accepted = parse_accept_encoding(accept_encoding)
+            for encoding, suffix in PRECOMPRESSED:
+                if encoding not in accepted:
+                    continue
+                compressed = cache.get(file_path + suffix)
+                if compressed is not None:
+                    headers['Content-Encoding'] = encoding
+                    headers['ETag'] = compressed.etag
+                    headers['Last-Modified'] = compressed.last_modified
+                    info = compressed._replace(
+                        content_type=info.content_type)
+                    file_path += suffix
+                    break
+
+        if info.body is not None:
+            return HTTPResponse(headers=headers,
+                                content_type=info.content_type,
+                                body_bytes=info.body)
+        return FileHTTPResponse(file_path, info.size,
+                                headers=headers,
+                                content_type=info.content_type,
+                                file=info.file)
+
+    if not is_file:
+        uri = uri.rstrip('/') + '/<file_uri:' + pattern + '>'
+
+    app.route(uri, methods=['GET', 'HEAD'])(_handler)
@@ -0,0 +1,236 @@
+import gc
+from multiprocessing import get_context
+from os import kill, sysconf
+from random import randint
+from time import monotonic
+from signal import signal, SIG_DFL, SIGHUP, SIGINT, SIGKILL, SIGTERM
+
+from sanic.log import log
+
+PAGE_SIZE = sysconf('SC_PAGE_SIZE')     # 内存页大小，用于计算 RSS
+READY_TIMEOUT = 30                      # 等待新进程开始监听的最长时间，单位秒
+SIGNAL_GRACE = 0.5                      # 等待工作进程响应进程组信号的时间，单位秒
+
+
+def get_rss(pid):
+    """
+    读取进程的常驻内存大小
+    :param pid: 进程 id
+    :return: 以字节为单位的 RSS，无法读取时返回 None
+    """
+    try:
+        with open('/proc/{}/statm'.format(pid), 'rb') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def run_worker(target, settings):
+    """
+    工作进程入口。恢复默认的信号处理，避免在服务器注册信号处理之前
+    收到的信号执行从主进程继承的处理函数
+    """
+    for signum in (SIGINT, SIGTERM, SIGHUP):
+        signal(signum, SIG_DFL)
+    target(**settings)
+
+
+class Worker:
+    """
+    工作进程及其监听就绪、开始排空事件
+    """
+    __slots__ = ('process', 'ready', 'draining')
+
+    def __init__(self, process, ready, draining):
+        self.process = process
+        self.ready = ready
+        self.draining = draining
+
+
+class Supervisor:
+    """
+    主进程，负责启动并看管工作进程：
+      - 工作进程意外退出或处理的请求数达到上限后退出时，启动新的进程代替
+      - 工作进程的 RSS 超过上限时，先启动新进程，再平滑关闭旧进程
+      - 收到 SIGHUP 时逐个替换所有工作进程
+    监听套接字由主进程创建并被工作进程继承，替换进程期间仍然接受连接。
+    预加载模式下，应用在主进程中导入和初始化，冻结 GC 后 fork 出工作进程，
+    路由表、编译后的正则等对象以写时复制的方式在进程间共享。
+    """
+
+    def __init__(self, target, settings, workers, max_requests=0,
+                 max_requests_jitter=0, max_rss=0, check_interval=1,
+                 graceful_timeout=15, preload=True):
+        """
+        :param target: 工作进程执行的函数，接受 `settings` 作为关键字参数
+        :param settings: 服务配置参数
+        :param workers: 进程数
+        :param max_requests: 单个进程处理的请求数上限，0 为不限制
+        :param max_requests_jitter: 请求数上限的随机增量，避免进程同时重启
+        :param max_rss: 以字节为单位，单个进程的内存上限，0 为不限制
+        :param check_interval: 以秒为单位，检查工作进程的间隔
+        :param graceful_timeout: 以秒为单位，等待旧进程退出的时间
+        :param preload: 是否以 fork 方式启动共享主进程内存的工作进程
+        """
+        self.target = target
+        self.settings = settings
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.max_rss = max_rss
+        self.check_interval = check_interval
+        self.graceful_timeout = graceful_timeout
+        self.preload = preload
+        # 预加载必须使用 fork，其它启动方式会在工作进程中重新导入应用
+        self.context = get_context('fork' if preload else None)
+        self.processes = []         # 正在运行的工作进程，供 Sanic.stop 使用
+        self._workers = []
+        self._reload = False
+        self._stopping = False
+        self._stop_signal = None    # 使主进程退出的信号
+
+    def spawn(self):
+        """
+        启动一个工作进程
+        """
+        settings = dict(self.settings)
+        if self.max_requests:
+            settings['max_requests'] = self.max_requests + \
+                randint(0, self.max_requests_jitter)
+        ready = self.context.Event()
+        draining = self.context.Event()
+        settings['ready_event'] = ready
+        settings['drain_event'] = draining
+        process = self.context.Process(
+            target=run_worker, args=(self.target, settings))
+        process.daemon = True
+        process.start()
+        worker = Worker(process, ready, draining)
+        self._workers.append(worker)
+        self.processes.append(process)
+        return worker
+
+    def retire(self, worker):
+        """
+        平滑关闭工作进程，超时后强制结束
+        """
+        self._workers.remove(worker)
+        self.processes.remove(worker.process)
+        worker.process.terminate()
+        self.join(worker)
+
+    def join(self, worker):
+        """
+        等待工作进程退出，超时后强制结束
+        """
+        worker.process.join(self.graceful_timeout + 5)
+        if worker.process.is_alive():
+            log.warning("Worker {} did not exit, killing".format(
+                worker.process.pid))
+            kill(worker.process.pid, SIGKILL)
+            worker.process.join()
+
+    def replace(self, worker):
+        """
+        先启动新进程，等待其开始监听后再关闭旧进程
+        """
+        if self._stopping:
+            return
+        new_worker = self.spawn()
+        if not new_worker.ready.wait(READY_TIMEOUT):
+            log.error("Worker {} failed to start".format(
+                new_worker.process.pid))
+        self.retire(worker)
+
+    def reap(self):
+        """
+        启动新进程代替已退出的工作进程
+        """
+        for worker in list(self._workers):
+            if self._stopping:
+                return
+            process = worker.process
+            if process.is_alive():
+                continue
+            process.join()
+            if process.exitcode:
+                log.error("Worker {} died with exit code {}, restarting"
+                          .format(process.pid, process.exitcode))
+            else:
+                log.info("Worker {} exited, restarting".format(process.pid))
+            self._workers.remove(worker)
+            self.processes.remove(process)
+            self.spawn()
+
+    def check_memory(self):
+        """
+        替换 RSS 超过上限的工作进程
+        """
+        for worker in list(self._workers):
+            rss = get_rss(worker.process.pid)
+            if rss is not None and rss > self.max_rss:
+                log.info("Worker {} RSS {} exceeds {}, recycling".format(
+                    worker.process.pid, rss, self.max_rss))
+                self.replace(worker)
+
+    def reload(self):
+        """
+        逐个替换所有工作进程
+        """
+        log.info("Reloading {} workers".format(len(self._workers)))
+        for worker in list(self._workers):
+            self.replace(worker)
+
+    def freeze(self):
+        """
+        回收垃圾后冻结主进程中的所有对象。被冻结的对象移入永久代，
+        工作进程的 GC 不再遍历它们，也就不会因修改 GC 头部而触发页复制
+        """
+        gc.collect()
+        if hasattr(gc, 'freeze'):   # Python 3.7+
+            gc.freeze()
+            log.info("Preloaded app, froze {} objects".format(
+                gc.get_freeze_count()))
+
+    def run(self, stop_event):
+        """
+        启动工作进程并一直看管，直到设置终止事件
+        :param stop_event: 终止事件
+        """
+        if self.preload:
+            self.freeze()
+        for _ in range(self.workers):
+            self.spawn()
+        # 信号处理只设置标志：在处理函数中调用 stop_event.set() 可能与
+        # 正在 wait 的主循环争用同一把锁而死锁
+        signal(SIGHUP, self._on_sighup)
+        signal(SIGINT, self._on_stop)
+        signal(SIGTERM, self._on_stop)
+
+        while not self._stopping and \
+                not stop_event.wait(self.check_interval):
+            if self._stopping:
+                break
+            self.reap()
+            if self.max_rss:
+                self.check_memory()
+            if self._reload:
+                self._reload = False
+                self.reload()
+
+        # 平滑关闭所有工作进程。终端的 Ctrl+C 会把 SIGINT 发送给整个进程组，
+        # 已经开始排空的工作进程不再重复发送信号
+        grace = SIGNAL_GRACE if self._stop_signal == SIGINT else 0
+        deadline = monotonic() + grace
+        for worker in self._workers:
+            if not worker.draining.wait(max(deadline - monotonic(), 0)):
+                worker.process.terminate()
+        for worker in self._workers:
+            self.join(worker)
+
+    def _on_sighup(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._stop_signal = signum
+        self._stopping = True